@@ -0,0 +1,234 @@
+import asyncio
+import os
+import time
+from typing import List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from executor import run_stage
+from metrics import ALERTS
+
+SENDGRID_URL = "https://api.sendgrid.com/v3/mail/send"
+ALERT_SUBJECT = "ALERT: Potential Threat For your Friend Detected"
+ALERT_MAX_ATTEMPTS = int(os.environ.get("ALERT_MAX_ATTEMPTS", 8))
+# Retries back off exponentially from the base delay up to the max delay
+ALERT_RETRY_BASE_SECONDS = float(os.environ.get("ALERT_RETRY_BASE_SECONDS", 2))
+ALERT_RETRY_MAX_SECONDS = float(os.environ.get("ALERT_RETRY_MAX_SECONDS", 300))
+ALERT_POLL_INTERVAL = float(os.environ.get("ALERT_POLL_INTERVAL", 1))
+# Delivered or failed alerts are kept this long for review
+ALERT_RECORD_TTL = int(os.environ.get("ALERT_RECORD_TTL", 7 * 24 * 3600))
+
+# A worker sending an alert holds it this long, if it dies the alert is due again afterwards
+ALERT_LEASE_SECONDS = float(os.environ.get("ALERT_LEASE_SECONDS", 60))
+
+# Sorted set of alert ids scored by when they are next due. An alert stays in it until it is
+# sent or given up on, claiming it only pushes its score back by the lease.
+OUTBOX_KEY = "alerts:outbox"
+
+# Create the alert and schedule it in one step, a crash can't leave one without the other
+ENQUEUE_SCRIPT = """
+if redis.call("HSETNX", KEYS[1], "status", "pending") == 0 then
+    return 0
+end
+redis.call("HSET", KEYS[1], unpack(ARGV, 4))
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+redis.call("ZADD", KEYS[2], ARGV[2], ARGV[3])
+return 1
+"""
+
+# Lease a due alert to this worker, fails if it isn't due or another worker holds it
+CLAIM_SCRIPT = """
+local due = redis.call("ZSCORE", KEYS[1], ARGV[1])
+if not due or tonumber(due) > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call("ZADD", KEYS[1], ARGV[3], ARGV[1])
+return 1
+"""
+
+
+class SendGridTransport:
+    """Sends alerts through the SendGrid v3 API over a pooled keep-alive session."""
+
+    def __init__(self, api_key: str, sender: str, pool_size: int = 8, timeout: float = 10):
+        self.sender = sender
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.headers.update({"Authorization": f"Bearer {api_key}"})
+
+    def send(self, alert: dict) -> int:
+        from sendgrid.helpers.mail import Mail, Email
+        message = Mail(
+            to_emails=alert["to"],
+            from_email=Email(self.sender),
+            subject=alert["subject"],
+            plain_text_content=alert["body"]
+            )
+        if alert.get("bcc"):
+            message.add_bcc(alert["bcc"])
+        response = self.session.post(SENDGRID_URL, json=message.get(), timeout=self.timeout)
+        response.raise_for_status()
+        #expected 202 Accepted
+        return response.status_code
+
+
+class FakeTransport:
+    """Local stand-in for tests, records alerts instead of sending them."""
+
+    def __init__(self, latency: float = 0.0, failures: int = 0):
+        self.latency = latency
+        self.failures = failures
+        self.sent: List[dict] = []
+
+    def send(self, alert: dict) -> int:
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failures > 0:
+            self.failures -= 1
+            raise requests.ConnectionError("Simulated SendGrid failure")
+        self.sent.append(alert)
+        return 202
+
+
+class AlertOutbox:
+    """
+    Durable outbox of alerts in Redis, delivered in the background with retries.
+    Each alert id is enqueued at most once and claimed by a single worker per attempt.
+    """
+
+    def __init__(self, redis_client, transport, event_log=None):
+        self.redis = redis_client
+        self.transport = transport
+        self._enqueue = redis_client.register_script(ENQUEUE_SCRIPT)
+        self._claim = redis_client.register_script(CLAIM_SCRIPT)
+        # Delivery outcomes are added to the user's event log
+        self.event_log = event_log
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def enqueue(self, alert_id: str, user_id: str, to: str, bcc: Optional[str], body: str,
+                subject: str = ALERT_SUBJECT) -> bool:
+        """Store the alert and schedule it, returns False if this alert id was already enqueued."""
+        alert_key = f"alert:{alert_id}"
+        now = time.time()
+        fields = {"user_id": user_id, "to": to or "", "bcc": bcc or "", "subject": subject,
+                  "body": body, "attempts": 0, "created": now}
+        args = [ALERT_RECORD_TTL, now, alert_id]
+        for field, value in fields.items():
+            args += [field, value]
+        if not self._enqueue(keys=[alert_key, OUTBOX_KEY], args=args):
+            return False
+        self.wake()
+        return True
+
+    def wake(self):
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def due(self, limit: int = 20) -> List[str]:
+        return [alert_id.decode('utf-8')
+                for alert_id in self.redis.zrangebyscore(OUTBOX_KEY, "-inf", time.time(), start=0, num=limit)]
+
+    def deliver(self, alert_id: str) -> Optional[bool]:
+        """
+        Try one delivery of a due alert.
+
+        Returns:
+            Optional[bool]: True if sent, False if it will be retried or gave up,
+            None if another worker claimed it first
+        """
+        # Only the worker holding the lease sends this attempt
+        if not self._claim(keys=[OUTBOX_KEY], args=[alert_id, time.time(), time.time() + ALERT_LEASE_SECONDS]):
+            return None
+        alert_key = f"alert:{alert_id}"
+        alert = {key.decode('utf-8'): value.decode('utf-8')
+                 for key, value in self.redis.hgetall(alert_key).items()}
+        if not alert or alert.get("status") in ("sent", "failed"):
+            # Expired, or finished by a worker that died before removing it
+            self.redis.zrem(OUTBOX_KEY, alert_id)
+            return None
+        attempts = int(alert.get("attempts", 0)) + 1
+        try:
+            status_code = self.transport.send(alert)
+        except Exception as e:
+            print(f"Error sending alert {alert_id} (attempt {attempts}): {e}")
+            if attempts >= ALERT_MAX_ATTEMPTS:
+                pipe = self.redis.pipeline()
+                pipe.hset(alert_key, mapping={"status": "failed", "attempts": attempts, "error": str(e)})
+                pipe.zrem(OUTBOX_KEY, alert_id)
+                pipe.execute()
+                self.failed += 1
+                ALERTS.inc(outcome="failed")
+                self._record(alert, alert_id, "failed", attempts)
+                return False
+            delay = min(ALERT_RETRY_BASE_SECONDS * 2 ** (attempts - 1), ALERT_RETRY_MAX_SECONDS)
+            # If this write fails the lease runs out and the alert is retried anyway
+            pipe = self.redis.pipeline()
+            pipe.hset(alert_key, mapping={"attempts": attempts, "error": str(e)})
+            pipe.zadd(OUTBOX_KEY, {alert_id: time.time() + delay})
+            pipe.execute()
+            self.retried += 1
+            ALERTS.inc(outcome="retried")
+            self._record(alert, alert_id, "retrying", attempts)
+            return False
+        # A crash before this point sends the alert again once the lease runs out, never not at all
+        pipe = self.redis.pipeline()
+        pipe.hset(alert_key, mapping={"status": "sent", "attempts": attempts,
+                                      "status_code": status_code, "sent": time.time()})
+        pipe.zrem(OUTBOX_KEY, alert_id)
+        pipe.execute()
+        self.delivered += 1
+        ALERTS.inc(outcome="delivered")
+        self._record(alert, alert_id, "sent", attempts)
+        print('Email sent')
+        return True
+
+    def _record(self, alert: dict, alert_id: str, status: str, attempts: int):
+        if self.event_log is not None:
+            self.event_log.record(alert.get("user_id"), "alert", alert_id=alert_id,
+                                  status=status, attempts=attempts)
+
+    def _next_wait(self) -> float:
+        """Sleep until the next retry is due, but never longer than the poll interval."""
+        upcoming = self.redis.zrange(OUTBOX_KEY, 0, 0, withscores=True)
+        if not upcoming:
+            return ALERT_POLL_INTERVAL
+        return min(max(upcoming[0][1] - time.time(), 0.01), ALERT_POLL_INTERVAL)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                due = self.due()
+                await asyncio.gather(*(run_stage("send_email_alert", self.deliver, alert_id)
+                                       for alert_id in due))
+            except Exception as e:
+                print(f"Error processing alert outbox: {e}")
+                due = []
+            if not due:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self._next_wait())
+                except asyncio.TimeoutError:
+                    pass
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {"pending": self.redis.zcard(OUTBOX_KEY),
+                "delivered": self.delivered,
+                "retried": self.retried,
+                "failed": self.failed}
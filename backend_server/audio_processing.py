@@ -0,0 +1,113 @@
+import io
+import os
+import wave
+from typing import TYPE_CHECKING, Optional, Tuple, Union
+
+from recognizer import SAMPLE_RATE_HERTZ
+from services import services
+
+if TYPE_CHECKING:
+    import numpy as np
+    from pedalboard import Pedalboard
+
+# Set PREPROCESS_AUDIO=False to send fragments to Speech-to-Text untouched
+PREPROCESS_AUDIO = os.environ.get("PREPROCESS_AUDIO", "True") == "True"
+
+# Frame-energy voice activity detection
+VAD_FRAME_MS = int(os.environ.get("VAD_FRAME_MS", 30))
+VAD_THRESHOLD_DB = float(os.environ.get("VAD_THRESHOLD_DB", -45.0))
+# A fragment needs at least this many voiced frames to be worth transcribing
+VAD_MIN_VOICED_FRAMES = int(os.environ.get("VAD_MIN_VOICED_FRAMES", 5))
+
+
+def build_board() -> "Pedalboard":
+    """
+    Build the conditioning chain applied before Speech-to-Text.
+    Every parameter can be tuned through the matching environment variable.
+    """
+    from pedalboard import Pedalboard, NoiseGate, Compressor, LowShelfFilter, Gain, HighShelfFilter, Limiter
+    return Pedalboard([
+        NoiseGate(threshold_db=float(os.environ.get("NOISE_GATE_THRESHOLD_DB", -40)),
+                  ratio=float(os.environ.get("NOISE_GATE_RATIO", 1.5)),
+                  release_ms=float(os.environ.get("NOISE_GATE_RELEASE_MS", 250))),
+        Compressor(threshold_db=float(os.environ.get("COMPRESSOR_THRESHOLD_DB", -16)),
+                   ratio=float(os.environ.get("COMPRESSOR_RATIO", 4))),
+        LowShelfFilter(cutoff_frequency_hz=float(os.environ.get("LOW_SHELF_CUTOFF_HZ", 400)),
+                       gain_db=float(os.environ.get("LOW_SHELF_GAIN_DB", 10)), q=1),
+        Gain(gain_db=float(os.environ.get("GAIN_DB", 2))),
+        HighShelfFilter(cutoff_frequency_hz=float(os.environ.get("HIGH_SHELF_CUTOFF_HZ", 6000)),
+                        gain_db=float(os.environ.get("HIGH_SHELF_GAIN_DB", -4)), q=1),
+        Limiter(threshold_db=float(os.environ.get("LIMITER_THRESHOLD_DB", -1))),
+    ])
+
+
+# pedalboard and numpy are only loaded once the first fragment is conditioned, or during warm-up
+services.register("audio_board", build_board)
+
+
+def decode_audio(audio: Union[bytes, memoryview, str]) -> "np.ndarray":
+    """Decode a WAV fragment to mono float32 samples at SAMPLE_RATE_HERTZ."""
+    import numpy as np
+    from pedalboard.io import AudioFile
+    source = audio if isinstance(audio, str) else io.BytesIO(audio)
+    with AudioFile(source) as f:
+        with f.resampled_to(SAMPLE_RATE_HERTZ) as resampled:
+            samples = resampled.read(resampled.frames)
+    return samples.mean(axis=0, dtype=np.float32)
+
+
+def voice_activity(samples: "np.ndarray") -> dict:
+    """
+    Frame-energy statistics for a mono fragment.
+
+    Args:
+        samples (np.ndarray): Mono float32 samples at SAMPLE_RATE_HERTZ
+
+    Returns:
+        dict: frames, voiced_frames, voiced_ratio and peak_db of the fragment
+    """
+    import numpy as np
+    frame_size = SAMPLE_RATE_HERTZ * VAD_FRAME_MS // 1000
+    n_frames = len(samples) // frame_size
+    if n_frames == 0:
+        return {"frames": 0, "voiced_frames": 0, "voiced_ratio": 0.0, "peak_db": -np.inf}
+    frames = samples[:n_frames * frame_size].reshape(n_frames, frame_size)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1))
+    energy_db = 20 * np.log10(np.maximum(rms, 1e-10))
+    voiced_frames = int(np.count_nonzero(energy_db > VAD_THRESHOLD_DB))
+    return {"frames": n_frames,
+            "voiced_frames": voiced_frames,
+            "voiced_ratio": voiced_frames / n_frames,
+            "peak_db": float(energy_db.max())}
+
+
+def encode_wav(samples: "np.ndarray") -> bytes:
+    """Encode mono float samples as 16-bit LINEAR16 WAV, as RecognitionConfig expects."""
+    import numpy as np
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE_HERTZ)
+        wav.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+def condition_audio(audio: Union[bytes, memoryview, str]) -> Tuple[Optional[bytes], dict]:
+    """
+    Resample, condition and gate an uploaded fragment.
+
+    Args:
+        audio (Union[bytes, memoryview, str]): WAV content or the path of a spilled upload
+
+    Returns:
+        Tuple[Optional[bytes], dict]: The conditioned 16 kHz WAV, or None when the fragment
+        has no voiced frames, and the voice activity statistics.
+    """
+    samples = decode_audio(audio)
+    processed = services.get("audio_board")(samples, SAMPLE_RATE_HERTZ)
+    stats = voice_activity(processed)
+    if stats["voiced_frames"] < VAD_MIN_VOICED_FRAMES:
+        return None, stats
+    return encode_wav(processed), stats
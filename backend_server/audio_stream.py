@@ -0,0 +1,149 @@
+import asyncio
+import json
+import os
+import secrets
+import time
+from collections import OrderedDict
+from typing import Optional, Set, Tuple, Union
+
+# Binary upload frames on /ws/{user_id}:
+#   2 bytes   big-endian length of the JSON header
+#   header    {"seq": 12, "final": false, "gps": "lat: ..; long: ..", "labels": [["Speech", 0.91]]}
+#   rest      the next chunk of the fragment's WAV, split on sample boundaries
+# Chunks of a fragment share its seq, the chunk with "final": true completes it.
+# gps and labels may come with any chunk, the latest value wins.
+# Each completed fragment is answered with {"type": "ack", "seq": ..., "evaluation": ...}.
+
+# Largest fragment accepted on a WebSocket, 5 seconds of 16 kHz mono audio are ~160 KB
+WS_MAX_FRAGMENT_BYTES = int(os.environ.get("WS_MAX_FRAGMENT_BYTES", 4 * 1024 * 1024))
+# Fragments of one connection being transcribed at the same time. Beyond this the
+# server stops reading the socket until one is acknowledged.
+WS_MAX_INFLIGHT_FRAGMENTS = int(os.environ.get("WS_MAX_INFLIGHT_FRAGMENTS", 2))
+# Unfinished fragments kept per connection, the oldest is dropped first
+WS_MAX_OPEN_FRAGMENTS = int(os.environ.get("WS_MAX_OPEN_FRAGMENTS", 4))
+
+HEADER_LENGTH_BYTES = 2
+
+# Fragments of closed sockets still being processed, held here until they finish
+_draining: Set[asyncio.Task] = set()
+
+
+class FrameError(ValueError):
+    pass
+
+
+def parse_frame(data: bytes) -> Tuple[dict, memoryview]:
+    """
+    Split a binary upload frame.
+
+    Returns:
+        Tuple[dict, memoryview]: The metadata header and the audio chunk
+    """
+    if len(data) < HEADER_LENGTH_BYTES:
+        raise FrameError("Frame too short")
+    header_end = HEADER_LENGTH_BYTES + int.from_bytes(data[:HEADER_LENGTH_BYTES], "big")
+    try:
+        header = json.loads(bytes(data[HEADER_LENGTH_BYTES:header_end]))
+    except ValueError:
+        raise FrameError("Invalid frame header")
+    if not isinstance(header, dict) or not isinstance(header.get("seq"), int):
+        raise FrameError("Frame header needs an integer seq")
+    return header, memoryview(data)[header_end:]
+
+
+def encode_frame(header: dict, chunk: bytes) -> bytes:
+    """Build a binary upload frame, the client side of parse_frame."""
+    encoded = json.dumps(header).encode('utf-8')
+    return len(encoded).to_bytes(HEADER_LENGTH_BYTES, "big") + encoded + bytes(chunk)
+
+
+class PartialFragment:
+    __slots__ = ("seq", "request_id", "received", "gps", "labels", "audio", "chunks", "complete", "streamed",
+                 "rejected")
+
+    def __init__(self, seq: int):
+        self.seq = seq
+        # Follows the fragment through evaluation and alerting, like /upload's
+        self.request_id = secrets.token_hex(8)
+        self.received = time.time()
+        self.gps: Optional[str] = None
+        self.labels: Union[str, list, None] = None
+        self.audio = bytearray()
+        self.chunks = 0
+        self.complete = False
+        # Set when the chunks were also fed to the streaming recognizer as they arrived
+        self.streamed = False
+        # Set when the first chunk was over the rate limit, the rest of the fragment is discarded
+        self.rejected = False
+
+
+class FragmentAssembler:
+    """Puts together the fragments sent in chunks on one WebSocket."""
+
+    def __init__(self, max_bytes: int = WS_MAX_FRAGMENT_BYTES,
+                 max_inflight: int = WS_MAX_INFLIGHT_FRAGMENTS,
+                 max_open: int = WS_MAX_OPEN_FRAGMENTS):
+        self.max_bytes = max_bytes
+        self.max_open = max_open
+        # Taken when a fragment is complete, released once it is acknowledged
+        self.slots = asyncio.Semaphore(max_inflight)
+        self._open: "OrderedDict[int, PartialFragment]" = OrderedDict()
+        # Completed fragments being transcribed, they run to the end even if the socket closes
+        self.tasks: Set[asyncio.Task] = set()
+        self.fragments = 0
+        self.dropped = 0
+
+    def add(self, header: dict, chunk: memoryview) -> PartialFragment:
+        """Append a chunk, the returned fragment is complete once its final chunk arrived."""
+        seq = header["seq"]
+        fragment = self._open.get(seq)
+        if fragment is None:
+            fragment = PartialFragment(seq)
+            self._open[seq] = fragment
+            if len(self._open) > self.max_open:
+                # The client gave up on it without sending the final chunk
+                self._open.popitem(last=False)
+                self.dropped += 1
+        if len(fragment.audio) + len(chunk) > self.max_bytes:
+            del self._open[seq]
+            self.dropped += 1
+            raise FrameError(f"Fragment {seq} is larger than {self.max_bytes} bytes")
+        fragment.chunks += 1
+        if not fragment.rejected:
+            fragment.audio += chunk
+        if header.get("gps"):
+            fragment.gps = header["gps"]
+        if header.get("labels"):
+            fragment.labels = header["labels"]
+        if header.get("final"):
+            del self._open[seq]
+            fragment.complete = True
+            self.fragments += 1
+        return fragment
+
+    def track(self, task: asyncio.Task):
+        """Hold a reference to a fragment's task until it is done."""
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def drop_unfinished(self) -> int:
+        """Forget fragments whose final chunk never arrived, e.g. because the socket closed."""
+        dropped = len(self._open)
+        self._open.clear()
+        self.dropped += dropped
+        return dropped
+
+    async def drain(self):
+        """Wait for the completed fragments, a safe word said just before the socket dropped still counts."""
+        for task in self.tasks:
+            _draining.add(task)
+            task.add_done_callback(_draining.discard)
+        # Unlike gather, wait doesn't cancel the fragments if the endpoint itself is cancelled
+        if self.tasks:
+            await asyncio.wait(set(self.tasks))
+
+    def stats(self) -> dict:
+        return {"open": len(self._open),
+                "in_flight": len(self.tasks),
+                "fragments": self.fragments,
+                "dropped": self.dropped}
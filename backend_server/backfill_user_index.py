@@ -0,0 +1,10 @@
+"""
+One-shot migration: index existing users by user_id.
+
+Run once against the Memorystore instance after deploying:
+    python backfill_user_index.py
+"""
+from utils import backfill_user_id_index
+
+if __name__ == "__main__":
+    backfill_user_id_index()
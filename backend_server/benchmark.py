@@ -0,0 +1,350 @@
+"""
+Offline load test of the upload -> alert pipeline.
+
+Boots main.app in-process with local stand-ins for Redis (fakeredis, or a local
+redis-server with --redis-host), Speech-to-Text, Gemini and SendGrid, each with a
+configurable latency. N simulated phones log in, hold a WebSocket and send 5-second
+WAV fragments, as /upload POSTs or with --upload ws as binary WebSocket frames.
+Reports uploads/sec, p50/p95/p99 per stage and CPU per idle connection.
+
+    python benchmark.py --phones 50 --fragments 10 --interval 1 --json bench.json
+
+Needs httpx and, unless --redis-host is given, fakeredis.
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import sys
+import time
+import wave
+from collections import defaultdict
+
+# Tokens are still signed for real, the other credentials are never used by the stand-ins
+os.environ.setdefault("JWT_SECRET_KEY", "benchmark")
+# Every simulated phone comes from the same address, measure the pipeline rather than the limiter
+os.environ.setdefault("RATE_LIMIT", "False")
+
+import numpy as np
+
+from audio_stream import encode_frame
+
+SAMPLE_RATE_HERTZ = 16000
+THREAT_PROMPT = "Threat detected. Please confirm if you are in danger."
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """Stand-in for GenerativeModel, flags a share of the calls as threats."""
+
+    def __init__(self, latency: float, threat_rate: float):
+        self.latency = latency
+        self.threat_rate = threat_rate
+        self.calls = 0
+
+    def generate_content(self, messages, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        if "generation_config" not in kwargs:
+            return FakeResponse("Hey, I think I'm in danger, please come and get me.")
+        threat = random.random() < self.threat_rate
+        return FakeResponse(json.dumps({
+            "threat_level": "1" if threat else "0",
+            "explanation": "Simulated verdict",
+            "alert_message": "Hey, I think I'm in danger, please come and get me." if threat else "",
+        }))
+
+
+def make_fragment(seconds: float = 5.0) -> bytes:
+    """A 16 kHz mono WAV with speech-like bursts, so the VAD lets it through."""
+    t = np.arange(int(seconds * SAMPLE_RATE_HERTZ)) / SAMPLE_RATE_HERTZ
+    envelope = (np.sin(2 * np.pi * 1.5 * t) > 0).astype(np.float32)
+    samples = 0.3 * envelope * np.sin(2 * np.pi * 220 * t) + 0.002 * np.random.randn(len(t))
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE_HERTZ)
+        wav.writeframes((np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(int(math.ceil(q / 100 * len(ordered))) - 1, len(ordered) - 1)
+    return ordered[max(index, 0)]
+
+
+def summarize(values) -> dict:
+    return {"count": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99)}
+
+
+class ASGIWebSocket:
+    """Minimal in-process WebSocket client speaking ASGI directly to the app."""
+
+    def __init__(self, app, path: str):
+        self.app = app
+        self.path = path
+        self.to_app: asyncio.Queue = asyncio.Queue()
+        self.from_app: asyncio.Queue = asyncio.Queue()
+        self.task = None
+
+    async def connect(self):
+        scope = {"type": "websocket", "asgi": {"version": "3.0"}, "scheme": "ws",
+                 "path": self.path, "raw_path": self.path.encode(), "root_path": "",
+                 "query_string": b"", "headers": [], "subprotocols": [],
+                 "server": ("benchmark", 80), "client": ("127.0.0.1", 0)}
+        self.task = asyncio.create_task(self.app(scope, self.to_app.get, self.from_app.put))
+        await self.to_app.put({"type": "websocket.connect"})
+        message = await self.from_app.get()
+        if message["type"] != "websocket.accept":
+            raise ConnectionError(f"WebSocket rejected: {message}")
+
+    async def send_text(self, text: str):
+        await self.to_app.put({"type": "websocket.receive", "text": text})
+
+    async def send_bytes(self, data: bytes):
+        await self.to_app.put({"type": "websocket.receive", "bytes": data})
+
+    async def receive(self) -> dict:
+        return await self.from_app.get()
+
+    async def close(self):
+        await self.to_app.put({"type": "websocket.disconnect", "code": 1000})
+        if self.task is not None:
+            await asyncio.wait([self.task], timeout=5)
+
+
+class Lifespan:
+    """Runs the app's startup and shutdown hooks like uvicorn would."""
+
+    def __init__(self, app):
+        self.app = app
+        self.to_app: asyncio.Queue = asyncio.Queue()
+        self.from_app: asyncio.Queue = asyncio.Queue()
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.app({"type": "lifespan", "asgi": {"version": "3.0"}},
+                                                 self.to_app.get, self.from_app.put))
+        await self.to_app.put({"type": "lifespan.startup"})
+        await self.from_app.get()
+
+    async def __aexit__(self, *exc):
+        await self.to_app.put({"type": "lifespan.shutdown"})
+        await self.from_app.get()
+
+
+async def phone(index: int, args, main, client, fragment: bytes, results: dict, idle: asyncio.Event):
+    user_id = f"bench-{index}"
+    response = await client.post("/login", json={"username": user_id, "password": "benchmark"})
+    token = response.json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    websocket = ASGIWebSocket(main.app, f"/ws/{user_id}")
+    await websocket.connect()
+    await websocket.send_text(json.dumps({"token": token}))
+
+    acks: asyncio.Queue = asyncio.Queue()
+
+    async def listen():
+        while True:
+            message = await websocket.receive()
+            if message["type"] != "websocket.send":
+                return
+            if message.get("text") == THREAT_PROMPT:
+                results["prompts"] += 1
+                if random.random() < args.cancel_rate:
+                    await client.post("/cancel", headers=headers)
+            elif message.get("text", "").startswith('{"type": "ack"'):
+                await acks.put(json.loads(message["text"]))
+
+    listener = asyncio.create_task(listen())
+    # Spread the phones over the first interval like real recordings would be
+    await asyncio.sleep(random.random() * args.interval)
+    for seq in range(args.fragments):
+        started = time.perf_counter()
+        if args.upload == "ws":
+            # Send the fragment in chunks like a phone streaming it while recording
+            for offset in range(0, len(fragment), args.chunk_bytes):
+                header = {"seq": seq, "final": offset + args.chunk_bytes >= len(fragment),
+                          "gps": "lat: 44.4268; long: 26.1025",
+                          "labels": '<Category "Speech" (displayName= score=0.91'}
+                await websocket.send_bytes(encode_frame(header, fragment[offset:offset + args.chunk_bytes]))
+            await acks.get()
+            elapsed = time.perf_counter() - started
+            results["upload"].append(elapsed)
+            results["status"]["ack"] += 1
+            await asyncio.sleep(max(args.interval - elapsed, 0))
+            continue
+        response = await client.post("/upload", headers=headers,
+                                     files={"file": ("fragment.wav", fragment, "audio/wav")},
+                                     data={"audioFileName": "fragment.wav",
+                                           "gps": "lat: 44.4268; long: 26.1025",
+                                           "label": '<Category "Speech" (displayName= score=0.91'})
+        elapsed = time.perf_counter() - started
+        results["upload"].append(elapsed)
+        results["status"][response.status_code] += 1
+        await asyncio.sleep(max(args.interval - elapsed, 0))
+    await idle.wait()
+    listener.cancel()
+    await websocket.close()
+
+
+async def run(args) -> dict:
+    import redis
+    if args.redis_host:
+        os.environ["REDISHOST"] = args.redis_host
+        os.environ["REDISPORT"] = str(args.redis_port)
+    else:
+        try:
+            import fakeredis
+        except ImportError:
+            sys.exit("fakeredis is required without --redis-host (pip install fakeredis)")
+        server = fakeredis.FakeServer()
+        redis.StrictRedis = lambda *a, **kw: fakeredis.FakeStrictRedis(server=server)
+    try:
+        import httpx
+    except ImportError:
+        sys.exit("httpx is required (pip install httpx)")
+
+    import metrics
+    # Keep raw samples next to the histograms to report exact percentiles
+    stage_samples = defaultdict(list)
+    observe = metrics.Histogram.observe
+
+    def recording_observe(self, value, **labels):
+        if self is metrics.STAGE_SECONDS:
+            name = labels["stage"]
+        elif self is metrics.STAGE_WAIT_SECONDS:
+            name = f"{labels['stage']} (wait)"
+        else:
+            name = self.name.replace("hearmesafe_", "")
+        stage_samples[name].append(value)
+        observe(self, value, **labels)
+
+    metrics.Histogram.observe = recording_observe
+
+    import recognizer
+    recognizer.set_recognizer(recognizer.FakeRecognizer(
+        ["I'm walking home", "leave me alone", "please stop following me"], latency=args.stt_latency))
+    import utils
+    import alerts
+    import main
+    from services import services
+    model = FakeGenerativeModel(args.llm_latency, args.threat_rate)
+    services.set("gemini_model", model)
+    transport = alerts.FakeTransport(latency=args.email_latency)
+    services.set("alert_transport", transport)
+
+    # One bcrypt hash shared by every simulated user keeps setup fast
+    hashed_password = utils.get_password_hash("benchmark")
+    pipe = utils.redis_client.pipeline()
+    for index in range(args.phones):
+        user_id = f"bench-{index}"
+        pipe.hset(f"user:{user_id}", mapping={"hashed_password": hashed_password, "user_id": user_id,
+                                              "isThreat": "False", "personal_email": "me@example.com",
+                                              "friend_email": "friend@example.com", "safe_word": "purple monkey"})
+        pipe.set(f"user_id:{user_id}", user_id)
+    pipe.execute()
+
+    fragment = make_fragment()
+    results = {"upload": [], "status": defaultdict(int), "prompts": 0}
+    idle = asyncio.Event()
+    transport_asgi = httpx.ASGITransport(app=main.app)
+    async with Lifespan(main.app), httpx.AsyncClient(transport=transport_asgi, base_url="http://benchmark",
+                                                     timeout=60) as client:
+        started = time.perf_counter()
+        phones = [asyncio.create_task(phone(i, args, main, client, fragment, results, idle))
+                  for i in range(args.phones)]
+        while len(results["upload"]) < args.phones * args.fragments:
+            if any(task.done() and task.exception() for task in phones):
+                break
+            await asyncio.sleep(0.05)
+        duration = time.perf_counter() - started
+        # Let confirmation windows and alert deliveries finish
+        await asyncio.sleep(args.drain)
+
+        # CPU burnt by open but idle connections
+        cpu_started, wall_started = time.process_time(), time.perf_counter()
+        await asyncio.sleep(args.idle_seconds)
+        idle_cpu = time.process_time() - cpu_started
+        idle_wall = time.perf_counter() - wall_started
+        connections = len(main.connection_manager)
+        idle.set()
+        await asyncio.gather(*phones, return_exceptions=True)
+
+    uploads = len(results["upload"])
+    return {
+        "config": vars(args),
+        "uploads": uploads,
+        "duration_seconds": duration,
+        "uploads_per_second": uploads / duration if duration else 0.0,
+        "status_codes": dict(results["status"]),
+        "threat_prompts": results["prompts"],
+        "alerts_sent": len(transport.sent),
+        "llm_calls": model.calls,
+        "upload_latency": summarize(results["upload"]),
+        "stages": {stage: summarize(values) for stage, values in sorted(stage_samples.items())},
+        "idle_connections": connections,
+        "idle_cpu_per_connection": idle_cpu / idle_wall / connections if connections else 0.0,
+        "scheduler": main.evaluation_scheduler.stats(),
+    }
+
+
+def print_report(report: dict):
+    print(f"\n{report['uploads']} uploads in {report['duration_seconds']:.2f} s "
+          f"({report['uploads_per_second']:.1f} uploads/s), status codes {report['status_codes']}")
+    print(f"threat prompts {report['threat_prompts']}, alerts sent {report['alerts_sent']}, "
+          f"LLM calls {report['llm_calls']}")
+    print(f"{'stage':<32}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = [("upload (client)", report["upload_latency"])] + list(report["stages"].items())
+    for stage, stats in rows:
+        print(f"{stage:<32}{stats['count']:>8}{stats['p50'] * 1000:>10.1f}"
+              f"{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}")
+    print(f"idle CPU per connection: {report['idle_cpu_per_connection'] * 100:.4f}% of a core "
+          f"over {report['idle_connections']} connections")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--phones", type=int, default=20, help="simulated phones")
+    parser.add_argument("--fragments", type=int, default=5, help="fragments sent by each phone")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between fragments of a phone")
+    parser.add_argument("--stt-latency", type=float, default=0.3, help="fake Speech-to-Text latency")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="fake Gemini latency")
+    parser.add_argument("--email-latency", type=float, default=0.2, help="fake SendGrid latency")
+    parser.add_argument("--threat-rate", type=float, default=0.05, help="share of verdicts that are threats")
+    parser.add_argument("--cancel-rate", type=float, default=0.5, help="share of prompts the phone cancels")
+    parser.add_argument("--drain", type=float, default=6.0, help="seconds to let alerts finish")
+    parser.add_argument("--idle-seconds", type=float, default=2.0, help="seconds to measure idle CPU")
+    parser.add_argument("--upload", choices=["http", "ws"], default="http",
+                        help="send fragments as /upload POSTs or as binary WebSocket frames")
+    parser.add_argument("--chunk-bytes", type=int, default=32 * 1024, help="WebSocket chunk size")
+    parser.add_argument("--redis-host", help="use a local redis-server instead of fakeredis")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the report to this file for regression tracking")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, default=str)
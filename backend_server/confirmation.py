@@ -0,0 +1,78 @@
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional
+
+# How long the user has to cancel a detected threat before the alert is sent
+THREAT_CONFIRMATION_TIMEOUT = float(os.environ.get("THREAT_CONFIRMATION_TIMEOUT", 5))
+MAX_PENDING_CONFIRMATIONS = int(os.environ.get("MAX_PENDING_CONFIRMATIONS", 1000))
+
+
+class PendingConfirmation:
+    """A threat waiting for the user to cancel or confirm it."""
+
+    def __init__(self, user_id: str, timeout: float):
+        self.user_id = user_id
+        self.timeout = timeout
+        self.created = time.time()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def resolve(self, confirmed: bool):
+        if not self.future.done():
+            self.future.set_result(confirmed)
+
+    async def wait(self) -> Optional[bool]:
+        """
+        Wait until the user answers or the window closes, timeout seconds after it was opened.
+
+        Returns:
+            Optional[bool]: True if confirmed, False if cancelled, None on timeout
+        """
+        try:
+            remaining = max(self.timeout - (time.time() - self.created), 0.0)
+            return await asyncio.wait_for(asyncio.shield(self.future), remaining)
+        except asyncio.TimeoutError:
+            return None
+
+
+class ConfirmationRegistry:
+    """Bounded set of pending confirmations, at most one per user."""
+
+    def __init__(self, max_pending: int = MAX_PENDING_CONFIRMATIONS):
+        self.max_pending = max_pending
+        self._pending: Dict[str, PendingConfirmation] = {}
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._pending
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def open(self, user_id: str, timeout: float = THREAT_CONFIRMATION_TIMEOUT) -> Optional[PendingConfirmation]:
+        """Start a confirmation window, returns None when the registry is full."""
+        if user_id in self._pending:
+            return self._pending[user_id]
+        if len(self._pending) >= self.max_pending:
+            return None
+        confirmation = PendingConfirmation(user_id, timeout)
+        self._pending[user_id] = confirmation
+        return confirmation
+
+    def resolve(self, user_id: str, confirmed: bool) -> bool:
+        """Resolve the user's pending confirmation, returns False if there was none."""
+        confirmation = self._pending.get(user_id)
+        if confirmation is None:
+            return False
+        confirmation.resolve(confirmed)
+        return True
+
+    def close(self, confirmation: PendingConfirmation):
+        if self._pending.get(confirmation.user_id) is confirmation:
+            del self._pending[confirmation.user_id]
+
+    def pending(self) -> List[dict]:
+        now = time.time()
+        return [{"user_id": c.user_id,
+                 "age": now - c.created,
+                 "remaining": max(c.timeout - (now - c.created), 0.0)}
+                for c in self._pending.values()]
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+from starlette.websockets import WebSocketState
+
+from metrics import WS_MESSAGES
+
+# Seconds a client has to send its auth message after connecting
+WS_AUTH_TIMEOUT = float(os.environ.get("WS_AUTH_TIMEOUT", 10))
+# Close connections that sent nothing for this long, 0 disables it.
+# Dead peers are already detected by uvicorn's protocol level pings (--ws-ping-interval),
+# this only applies to clients that send {"type": "ping"} heartbeats themselves.
+WS_IDLE_TIMEOUT = float(os.environ.get("WS_IDLE_TIMEOUT", 0))
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", 32))
+
+
+class Connection:
+    """An authenticated WebSocket with its own bounded send queue."""
+
+    def __init__(self, user_id: str, websocket: WebSocket, queue_size: int = WS_SEND_QUEUE_SIZE):
+        self.user_id = user_id
+        self.websocket = websocket
+        self.connected_at = time.time()
+        self.last_seen = time.monotonic()
+        self.sent = 0
+        self.dropped = 0
+        self.heartbeats = 0
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._sender = asyncio.create_task(self._send_loop())
+
+    async def _send_loop(self):
+        while True:
+            message = await self.queue.get()
+            try:
+                await self.websocket.send_text(message)
+                self.sent += 1
+                WS_MESSAGES.inc(outcome="sent")
+            except Exception as e:
+                print(f"Error sending message: {e}")
+                self.dropped += 1
+                WS_MESSAGES.inc(outcome="dropped")
+
+    def send(self, message: str) -> bool:
+        """Queue a message, returns False if the queue is full."""
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            WS_MESSAGES.inc(outcome="dropped")
+            return False
+
+    def idle_for(self) -> float:
+        return time.monotonic() - self.last_seen
+
+    def stats(self) -> dict:
+        return {"user_id": self.user_id,
+                "connected_for": time.time() - self.connected_at,
+                "idle_for": self.idle_for(),
+                "queued": self.queue.qsize(),
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "heartbeats": self.heartbeats}
+
+    @property
+    def dead(self) -> bool:
+        """The socket is closed or its sender stopped, but the connection is still registered."""
+        return (self.websocket.client_state == WebSocketState.DISCONNECTED
+                or self.websocket.application_state == WebSocketState.DISCONNECTED
+                or self._sender.done())
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        self._sender.cancel()
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            # Already closed by the client
+            pass
+
+
+class ConnectionManager:
+    """Keeps one authenticated connection per user and serves its receive loop."""
+
+    def __init__(self):
+        self.connections: Dict[str, Connection] = {}
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def get(self, user_id: str) -> Optional[Connection]:
+        return self.connections.get(user_id)
+
+    def send(self, user_id: str, message: str) -> bool:
+        connection = self.connections.get(user_id)
+        if connection is None:
+            return False
+        return connection.send(message)
+
+    def stats(self) -> List[dict]:
+        return [connection.stats() for connection in self.connections.values()]
+
+    async def authenticate(self, websocket: WebSocket,
+                           authenticate: Callable[[str], Awaitable[Optional[str]]]) -> Optional[str]:
+        """Wait for the {"token": ...} message and return the authenticated user_id."""
+        try:
+            auth_message = await asyncio.wait_for(websocket.receive_text(), WS_AUTH_TIMEOUT)
+            token = json.loads(auth_message).get('token')
+        except (asyncio.TimeoutError, ValueError, AttributeError, WebSocketDisconnect):
+            return None
+        return await authenticate(token) if token else None
+
+    async def register(self, user_id: str, websocket: WebSocket) -> Connection:
+        previous = self.connections.get(user_id)
+        connection = Connection(user_id, websocket)
+        self.connections[user_id] = connection
+        if previous is not None:
+            # The app reconnected, drop the stale socket
+            await previous.close(code=1000, reason="Replaced by a new connection")
+        return connection
+
+    async def unregister(self, connection: Connection):
+        if self.connections.get(connection.user_id) is connection:
+            del self.connections[connection.user_id]
+        await connection.close()
+
+    async def reap(self, max_idle: float = 0) -> int:
+        """
+        Unregister connections whose socket is gone, or that sent nothing for max_idle
+        seconds when it is set. Returns how many were removed.
+        """
+        stale = [connection for connection in self.connections.values()
+                 if connection.dead or (max_idle and connection.idle_for() > max_idle)]
+        for connection in stale:
+            print(f"Reaping connection idle for {connection.idle_for()} seconds")
+            await self.unregister(connection)
+        return len(stale)
+
+    async def serve(self, connection: Connection,
+                    on_message: Optional[Callable[[Connection, dict], Awaitable[None]]] = None):
+        """Receive until the client disconnects or goes idle, answering heartbeats."""
+        websocket = connection.websocket
+        timeout = WS_IDLE_TIMEOUT or None
+        while True:
+            try:
+                message = await asyncio.wait_for(websocket.receive(), timeout)
+            except asyncio.TimeoutError:
+                print(f"WebSocket idle for {connection.idle_for()} seconds, closing")
+                return
+            if message["type"] == "websocket.disconnect":
+                print(f"WebSocket disconnected with code {message.get('code')}")
+                return
+            connection.last_seen = time.monotonic()
+            if message.get("text") and _is_ping(message["text"]):
+                connection.heartbeats += 1
+                connection.send(json.dumps({"type": "pong"}))
+            elif on_message is not None:
+                await on_message(connection, message)
+
+
+def _is_ping(text: str) -> bool:
+    try:
+        return json.loads(text).get("type") == "ping"
+    except (ValueError, AttributeError):
+        return False
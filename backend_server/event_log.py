@@ -0,0 +1,138 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from executor import run_stage
+
+# Set EVENT_LOG=False to stop recording sessions
+EVENT_LOG_ENABLED = os.environ.get("EVENT_LOG", "True") == "True"
+# Events kept per user, trimmed approximately so Redis can drop whole nodes
+EVENT_LOG_MAXLEN = int(os.environ.get("EVENT_LOG_MAXLEN", 10000))
+# Events older than this are trimmed, and streams of users gone quiet expire
+EVENT_LOG_RETENTION_SECONDS = int(os.environ.get("EVENT_LOG_RETENTION_SECONDS", 30 * 24 * 3600))
+EVENT_LOG_BATCH_SIZE = int(os.environ.get("EVENT_LOG_BATCH_SIZE", 200))
+EVENT_LOG_FLUSH_INTERVAL = float(os.environ.get("EVENT_LOG_FLUSH_INTERVAL", 0.5))
+# Events waiting to be written, new ones are dropped beyond this if Redis falls behind
+EVENT_LOG_QUEUE_SIZE = int(os.environ.get("EVENT_LOG_QUEUE_SIZE", 10000))
+
+
+def stream_key(user_id: str) -> str:
+    return f"events:{user_id}"
+
+
+class EventLog:
+    """
+    Append-only per-user log of fragments, verdicts and alerts in Redis Streams.
+    record() only queues the event, a background task writes them in pipelined batches.
+    """
+
+    def __init__(self, redis_client, maxlen: int = EVENT_LOG_MAXLEN,
+                 retention: int = EVENT_LOG_RETENTION_SECONDS, enabled: bool = EVENT_LOG_ENABLED):
+        self.redis = redis_client
+        self.maxlen = maxlen
+        self.retention = retention
+        self.enabled = enabled
+        self.written = 0
+        self.dropped = 0
+        # Appended from the event loop and from worker threads
+        self._queue: deque = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, user_id: str, event: str, **fields) -> bool:
+        """Queue an event, fields that are None are left out. Returns False if it was dropped."""
+        if not self.enabled or not user_id:
+            return False
+        if len(self._queue) >= EVENT_LOG_QUEUE_SIZE:
+            self.dropped += 1
+            return False
+        # Stream ids are assigned when the batch is written, keep when it happened
+        entry = {"type": event, "time": f"{time.time():.3f}"}
+        entry.update((key, str(value)) for key, value in fields.items() if value is not None)
+        self._queue.append((user_id, entry))
+        if len(self._queue) >= EVENT_LOG_BATCH_SIZE and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return True
+
+    def flush(self, batch: List[Tuple[str, dict]]):
+        """Write a batch with one round trip, trimming each stream it touched."""
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id, entry in batch:
+            pipe.xadd(stream_key(user_id), entry, maxlen=self.maxlen, approximate=True)
+        oldest = f"{int((time.time() - self.retention) * 1000)}-0"
+        for user_id in {user_id for user_id, _ in batch}:
+            pipe.xtrim(stream_key(user_id), minid=oldest, approximate=True)
+            pipe.expire(stream_key(user_id), self.retention)
+        pipe.execute()
+        self.written += len(batch)
+
+    def _take_batch(self) -> List[Tuple[str, dict]]:
+        batch = []
+        while self._queue and len(batch) < EVENT_LOG_BATCH_SIZE:
+            batch.append(self._queue.popleft())
+        return batch
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            batch = self._take_batch()
+            if batch:
+                try:
+                    await run_stage("event_log", self.flush, batch)
+                except Exception as e:
+                    # Losing part of the log is better than holding up the pipeline
+                    print(f"Error writing {len(batch)} events: {e}")
+                    self.dropped += len(batch)
+            if len(self._queue) < EVENT_LOG_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), EVENT_LOG_FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # Write whatever is left before shutting down
+        while self._queue:
+            try:
+                self.flush(self._take_batch())
+            except Exception as e:
+                print(f"Error writing events on shutdown: {e}")
+                break
+
+    def read(self, user_id: str, before: Optional[str] = None, limit: int = 50) -> Tuple[List[dict], Optional[str]]:
+        """
+        Read a user's events, newest first.
+
+        Args:
+            user_id (str): The user whose stream to read
+            before (Optional[str]): Only events older than this id, the cursor of the previous page
+            limit (int): Page size
+
+        Returns:
+            Tuple[List[dict], Optional[str]]: The events, each with its id,
+            and the cursor of the next page or None on the last page
+        """
+        entries = self.redis.xrevrange(stream_key(user_id), max=f"({before}" if before else "+",
+                                       min="-", count=limit)
+        events = []
+        for entry_id, fields in entries:
+            event = {"id": entry_id.decode('utf-8')}
+            event.update((key.decode('utf-8'), value.decode('utf-8')) for key, value in fields.items())
+            events.append(event)
+        next_cursor = events[-1]["id"] if len(events) == limit else None
+        return events, next_cursor
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": len(self._queue),
+                "written": self.written,
+                "dropped": self.dropped}
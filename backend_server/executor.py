@@ -0,0 +1,61 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict
+
+from metrics import STAGE_SECONDS, STAGE_WAIT_SECONDS
+
+# Maximum number of concurrent calls per blocking stage of the upload pipeline.
+# Each limit can be overridden with <STAGE>_CONCURRENCY, e.g. TRANSCRIBE_AUDIO_CONCURRENCY=16
+DEFAULT_STAGE_CONCURRENCY = {
+    "transcribe_audio": 16,
+    "detect_threat": 16,
+    "generate_notif_message": 8,
+    "send_email_alert": 8,
+    # bcrypt is CPU bound, keep login bursts from taking every worker
+    "check_user": 4,
+    # Batches of events are written one at a time, in order
+    "event_log": 1,
+    "housekeeping": 1,
+}
+
+stage_concurrency: Dict[str, int] = {
+    stage: int(os.environ.get(f"{stage.upper()}_CONCURRENCY", default))
+    for stage, default in DEFAULT_STAGE_CONCURRENCY.items()
+}
+
+# One shared pool sized so that every stage can run at its limit at the same time
+executor = ThreadPoolExecutor(max_workers=sum(stage_concurrency.values()),
+                              thread_name_prefix="stage")
+
+_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def _get_semaphore(stage: str) -> asyncio.Semaphore:
+    semaphore = _semaphores.get(stage)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(stage_concurrency.get(stage, 1))
+        _semaphores[stage] = semaphore
+    return semaphore
+
+
+async def run_stage(stage: str, func: Callable, *args, **kwargs) -> Any:
+    """
+    Run a blocking pipeline call in the shared executor without blocking the event loop.
+
+    Args:
+        stage (str): The stage name, used to pick the concurrency limit
+        func (Callable): The blocking function to run
+        *args, **kwargs: Arguments passed to func
+
+    Returns:
+        Any: Whatever func returns. Exceptions raised by func propagate to the caller.
+    """
+    queued = time.perf_counter()
+    async with _get_semaphore(stage):
+        STAGE_WAIT_SECONDS.observe(time.perf_counter() - queued, stage=stage)
+        loop = asyncio.get_running_loop()
+        with STAGE_SECONDS.time(stage=stage):
+            return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
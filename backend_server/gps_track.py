@@ -0,0 +1,205 @@
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+# Samples kept per user, one comes with every fragment (5 seconds), so 60 is about 5 minutes
+GPS_TRACK_SIZE = int(os.environ.get("GPS_TRACK_SIZE", 60))
+# Only samples this recent describe where the user is going, older tracks are pruned
+GPS_TRACK_SECONDS = float(os.environ.get("GPS_TRACK_SECONDS", 300))
+MAX_GPS_TRACKS = int(os.environ.get("MAX_GPS_TRACKS", 10000))
+# Less than this between the first and last sample is GPS jitter, not movement
+GPS_TRACK_MIN_MOVEMENT_METERS = float(os.environ.get("GPS_TRACK_MIN_MOVEMENT_METERS", 25))
+# Points of the recent path linked in an alert
+GPS_TRACK_PATH_POINTS = int(os.environ.get("GPS_TRACK_PATH_POINTS", 8))
+
+# After a confirmed alert, keep emailing the contact the user's location until the threat is
+# cancelled or the duration is over. No Gemini call, only a new position is sent.
+LOCATION_UPDATES = os.environ.get("LOCATION_UPDATES", "True") == "True"
+LOCATION_UPDATE_INTERVAL = float(os.environ.get("LOCATION_UPDATE_INTERVAL", 60))
+LOCATION_UPDATE_DURATION = float(os.environ.get("LOCATION_UPDATE_DURATION", 30 * 60))
+LOCATION_UPDATE_SUBJECT = "Location update for your friend"
+
+EARTH_RADIUS_METERS = 6371000.0
+COMPASS_POINTS = ("north", "north-east", "east", "south-east", "south", "south-west", "west", "north-west")
+
+# "lat: 44.4268; long: 26.1025" as sent by the app
+_gps_pattern = re.compile(r"lat\w*\s*:\s*(-?\d+(?:\.\d+)?)\s*;\s*l(?:ong|ng|on)\w*\s*:\s*(-?\d+(?:\.\d+)?)",
+                          re.IGNORECASE)
+
+Point = Tuple[float, float]
+
+
+def parse_gps(gps: Optional[str]) -> Optional[Point]:
+    """
+    Parse the gps field sent with a fragment.
+
+    Returns:
+        Optional[Point]: (lat, long), or None if it is missing or not a valid position
+    """
+    if not gps:
+        return None
+    match = _gps_pattern.search(gps)
+    if not match:
+        return None
+    lat, long = float(match.group(1)), float(match.group(2))
+    if not (-90 <= lat <= 90 and -180 <= long <= 180):
+        return None
+    return lat, long
+
+
+def distance_meters(a: Point, b: Point) -> float:
+    """Great-circle distance between two points."""
+    lat1, long1, lat2, long2 = map(math.radians, (*a, *b))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(min(h, 1)))
+
+
+class TrackSummary(NamedTuple):
+    latest: Point
+    # When the latest sample was received
+    time: float
+    # Recent positions, oldest first, thinned out to GPS_TRACK_PATH_POINTS
+    path: List[Point]
+    # Along the path, over the recent samples
+    distance: float
+    elapsed: float
+    # Meters per second, 0 when not moving
+    speed: float
+    # Degrees clockwise from north between the first and last recent sample, None when not moving
+    heading: Optional[float]
+
+
+def summarize(samples, min_movement: float = GPS_TRACK_MIN_MOVEMENT_METERS,
+              path_points: int = GPS_TRACK_PATH_POINTS) -> TrackSummary:
+    """
+    Distance, speed and heading of a track in one vectorized pass.
+
+    Args:
+        samples: Array of (time, lat, long) rows, oldest first, at least one row
+    """
+    import numpy as np
+    times = samples[:, 0]
+    lat = np.radians(samples[:, 1])
+    long = np.radians(samples[:, 2])
+    # Haversine distance between consecutive samples
+    a = (np.sin(np.diff(lat) / 2) ** 2
+         + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(long) / 2) ** 2)
+    distance = float(np.sum(2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1)))))
+    elapsed = float(times[-1] - times[0])
+    # Net displacement tells walking away from standing still with a jittery fix
+    a = (np.sin((lat[-1] - lat[0]) / 2) ** 2
+         + np.cos(lat[0]) * np.cos(lat[-1]) * np.sin((long[-1] - long[0]) / 2) ** 2)
+    displacement = 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(min(a, 1)))
+    speed, heading = 0.0, None
+    if displacement >= min_movement and elapsed > 0:
+        speed = distance / elapsed
+        y = np.sin(long[-1] - long[0]) * np.cos(lat[-1])
+        x = np.cos(lat[0]) * np.sin(lat[-1]) - np.sin(lat[0]) * np.cos(lat[-1]) * np.cos(long[-1] - long[0])
+        heading = float(np.degrees(np.arctan2(y, x)) % 360)
+    indexes = np.unique(np.linspace(0, len(samples) - 1, min(path_points, len(samples))).round().astype(int))
+    path = [(round(float(row[1]), 6), round(float(row[2]), 6)) for row in samples[indexes]]
+    return TrackSummary(path[-1], float(times[-1]), path, distance, elapsed, speed, heading)
+
+
+def compass_direction(heading: float) -> str:
+    return COMPASS_POINTS[int((heading + 22.5) % 360 // 45)]
+
+
+def format_movement(summary: TrackSummary) -> str:
+    """Short description for the alert, e.g. "Moving north-east at about 5 km/h (400 m in the last 4 minutes)"."""
+    minutes = max(round(summary.elapsed / 60), 1)
+    period = "the last minute" if minutes == 1 else f"the last {minutes} minutes"
+    if summary.heading is None:
+        return f"Not moving much in {period}"
+    return (f"Moving {compass_direction(summary.heading)} at about {summary.speed * 3.6:.0f} km/h "
+            f"({summary.distance:.0f} m in {period})")
+
+
+class GpsTrack:
+    """Fixed-size ring buffer of a user's (time, lat, long) samples."""
+
+    __slots__ = ("samples", "count", "_next")
+
+    def __init__(self, size: int = GPS_TRACK_SIZE):
+        import numpy as np
+        self.samples = np.empty((size, 3))
+        self.count = 0
+        self._next = 0
+
+    def add(self, point: Point, received: float) -> bool:
+        """Record a sample, returns False if it is older than the latest one."""
+        if self.count and received <= self.latest_time():
+            # Fragments can finish out of order on a WebSocket
+            return False
+        self.samples[self._next] = (received, point[0], point[1])
+        self._next = (self._next + 1) % len(self.samples)
+        self.count = min(self.count + 1, len(self.samples))
+        return True
+
+    def latest_time(self) -> float:
+        return float(self.samples[self._next - 1, 0])
+
+    def recent(self, max_age: float = GPS_TRACK_SECONDS):
+        """Samples of the last max_age seconds before the latest one, oldest first."""
+        import numpy as np
+        ordered = np.roll(self.samples, -self._next, axis=0)[len(self.samples) - self.count:]
+        return ordered[ordered[:, 0] >= ordered[-1, 0] - max_age]
+
+
+class GpsTracks:
+    """Bounded set of per-user tracks, least recently updated users are dropped first."""
+
+    def __init__(self, max_tracks: int = MAX_GPS_TRACKS, max_age: float = GPS_TRACK_SECONDS):
+        self.max_tracks = max_tracks
+        self.max_age = max_age
+        self._tracks: "OrderedDict[str, GpsTrack]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._tracks)
+
+    def add(self, user_id: str, gps: Optional[str], received: float) -> Optional[Point]:
+        """
+        Record the gps sent with a fragment.
+
+        Returns:
+            Optional[Point]: The parsed position, None if there was none
+        """
+        point = parse_gps(gps)
+        if point is None:
+            return None
+        with self._lock:
+            track = self._tracks.pop(user_id, None)
+            if track is None:
+                track = GpsTrack()
+            track.add(point, received)
+            self._tracks[user_id] = track
+            if len(self._tracks) > self.max_tracks:
+                self._tracks.popitem(last=False)
+        return point
+
+    def summary(self, user_id: str, since: Optional[float] = None) -> Optional[TrackSummary]:
+        """Where the user is and how they are moving, None without recent samples or none after since."""
+        with self._lock:
+            track = self._tracks.get(user_id)
+            if track is None or not track.count:
+                return None
+            if track.latest_time() < time.time() - self.max_age:
+                return None
+            if since is not None and track.latest_time() <= since:
+                return None
+            samples = track.recent(self.max_age)
+        return summarize(samples)
+
+    def prune(self) -> int:
+        """Drop tracks without a sample in max_age seconds, returns how many."""
+        cutoff = time.time() - self.max_age
+        with self._lock:
+            idle = [user_id for user_id, track in self._tracks.items() if track.latest_time() < cutoff]
+            for user_id in idle:
+                del self._tracks[user_id]
+        return len(idle)
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import resource
+from typing import Awaitable, Callable, Dict, List
+
+from metrics import registry, ERRORS
+
+# Seconds between runs of each housekeeping job. Each one can be overridden with
+# HOUSEKEEPING_<JOB>_INTERVAL, e.g. HOUSEKEEPING_UPLOAD_FILES_INTERVAL=60, 0 disables the job.
+DEFAULT_HOUSEKEEPING_INTERVALS = {
+    "tokens": 300,
+    "upload_files": 600,
+    "sockets": 60,
+    "stuck_tasks": 30,
+    "caches": 300,
+}
+
+housekeeping_intervals: Dict[str, float] = {
+    job: float(os.environ.get(f"HOUSEKEEPING_{job.upper()}_INTERVAL", default))
+    for job, default in DEFAULT_HOUSEKEEPING_INTERVALS.items()
+}
+
+HOUSEKEEPING_REMOVED = registry.counter("hearmesafe_housekeeping_removed_total",
+                                        "Entries, files, sockets or tasks removed by housekeeping", ["job"])
+
+
+def resident_memory_bytes() -> int:
+    """Current resident set size, or the peak where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Housekeeper:
+    """
+    Runs cleanup jobs in the background so a long-running instance doesn't slowly leak.
+    Each job returns how many things it removed.
+    """
+
+    def __init__(self, intervals: Dict[str, float] = housekeeping_intervals):
+        self.intervals = intervals
+        self._jobs: Dict[str, Callable[[], Awaitable[int]]] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def add(self, name: str, job: Callable[[], Awaitable[int]]):
+        self._jobs[name] = job
+
+    async def run_job(self, name: str) -> int:
+        try:
+            removed = await self._jobs[name]()
+        except Exception as e:
+            ERRORS.inc(stage="housekeeping")
+            print(f"Error in housekeeping job {name}: {e}")
+            return 0
+        if removed:
+            HOUSEKEEPING_REMOVED.inc(removed, job=name)
+            print(f"Housekeeping {name}: removed {removed}")
+        return removed
+
+    async def _loop(self, name: str, interval: float):
+        # Run once right away, e.g. to clear files left behind by a crash
+        while True:
+            await self.run_job(name)
+            await asyncio.sleep(interval)
+
+    async def start(self):
+        for name in self._jobs:
+            interval = self.intervals.get(name, 0)
+            if interval > 0:
+                self._tasks.append(asyncio.create_task(self._loop(name, interval)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
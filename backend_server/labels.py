@@ -0,0 +1,81 @@
+import json
+import os
+import re
+from typing import Iterable, Optional, Tuple, Union
+
+# Sound classes detected on the phone, as (category, score) sorted by score
+Labels = Tuple[Tuple[str, float], ...]
+
+# Only labels scoring at least this much are worth mentioning to Gemini
+LABEL_SCORE_THRESHOLD = float(os.environ.get("LABEL_SCORE_THRESHOLD", 0.2))
+# Number of labels kept per fragment
+LABEL_TOP_K = int(os.environ.get("LABEL_TOP_K", 3))
+# Skip Gemini for fragments where no speech class clears the threshold.
+# The safe word is still checked on every transcript.
+LABEL_SPEECH_GATE = os.environ.get("LABEL_SPEECH_GATE", "False") == "True"
+# Classes of the phone's audio classifier that mean somebody is talking or calling out,
+# separated by ";" since the class names themselves contain commas
+SPEECH_CATEGORIES = frozenset(category.strip().lower() for category in os.environ.get(
+    "SPEECH_CATEGORIES",
+    "Speech;Child speech, kid speaking;Conversation;Narration, monologue;Babbling;Shout;Bellow;"
+    "Yell;Children shouting;Screaming;Whispering;Crying, sobbing;Whimper;Wail, moan;Groan").split(";"))
+
+# str(Category) as sent by older app versions
+_legacy_label_pattern = re.compile(r'<Category "(.*?)" \(displayName= score=(\d+(?:\.\d+)?)')
+
+
+def _compact(pairs: Iterable[Tuple[str, float]]) -> Labels:
+    return tuple(sorted(((str(category), float(score)) for category, score in pairs),
+                        key=lambda label: label[1], reverse=True))
+
+
+def parse_labels(raw: Union[str, list, None]) -> Labels:
+    """
+    Parse the labels sent with a fragment.
+
+    Args:
+        raw (Union[str, list, None]): A JSON list of {"category": ..., "score": ...} objects
+        or [category, score] pairs, as a string or already decoded, or the legacy
+        "<Category ...>" dump
+
+    Returns:
+        Labels: (category, score) pairs, highest score first
+    """
+    if not raw:
+        return ()
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            return _compact(_legacy_label_pattern.findall(raw))
+    try:
+        return _compact((label["category"], label["score"]) if isinstance(label, dict) else label
+                        for label in raw)
+    except (KeyError, TypeError, ValueError):
+        print("Invalid labels, ignoring them")
+        return ()
+
+
+def top_labels(labels: Labels, k: int = LABEL_TOP_K, threshold: float = LABEL_SCORE_THRESHOLD) -> Labels:
+    return tuple(label for label in labels if label[1] >= threshold)[:k]
+
+
+def merge_labels(labels: Iterable[Labels]) -> Labels:
+    """Combine the labels of several fragments, each class keeps its highest score."""
+    best = {}
+    for fragment_labels in labels:
+        for category, score in fragment_labels or ():
+            best[category] = max(score, best.get(category, score))
+    return _compact(best.items())
+
+
+def has_speech(labels: Labels, threshold: float = LABEL_SCORE_THRESHOLD) -> Optional[bool]:
+    """Whether a speech class clears the threshold, None if the phone sent no labels."""
+    if not labels:
+        return None
+    return any(score >= threshold and category.lower() in SPEECH_CATEGORIES for category, score in labels)
+
+
+def format_labels(labels: Optional[Labels]) -> str:
+    """Short form for the prompt, e.g. "Speech 0.91, Shout 0.42"."""
+    return ", ".join(f"{category} {score:.2f}" for category, score in labels or ())
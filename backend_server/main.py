@@ -1,62 +1,377 @@
+import time
+# Measures how long importing the app and its dependencies takes on a cold start
+_import_started = time.perf_counter()
 import jwt
 from datetime import datetime, timedelta, timezone
 import asyncio
 import os
 import json
 import secrets
-from typing import Dict
+from typing import Dict, Optional, Set
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, UploadFile, File, Form
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 import uvicorn
 import requests
-import time
+import math
+from contextlib import asynccontextmanager
 
 
 from utils import (AuthManager, 
                    save_user, check_user, check_temp_and_upload_folders, 
-                   save_file, delete_file, reset_memorystore,
+                   read_upload, release_upload, sweep_upload_dir, reset_memorystore,
                    transcribe_audio, change_threat_status, check_threat_status,
                    user_id_from_username, detect_threat, send_email_alert,
                    generate_notif_message_from_explanation, update_user_settings,
-                   get_user_settings, add_location_to_notification)
-
-app = FastAPI()
+                   get_user_settings, add_location_to_notification, format_location_update, contains_safe_word,
+                   redis_host, redis_port, redis_client, user_cache, alert_outbox, event_log)
+from executor import run_stage
+from recognizer import get_recognizer
+from audio_processing import PREPROCESS_AUDIO
+from audio_stream import FragmentAssembler, FrameError, PartialFragment, parse_frame
+from confirmation import ConfirmationRegistry
+from connections import ConnectionManager, WS_IDLE_TIMEOUT
+from message_bus import create_message_bus
+from user_cache import USER_CACHE_KEYSPACE_INVALIDATION
+from transcript_window import TranscriptWindows
+from scheduler import EvaluationScheduler, Fragment, EVALUATION_STUCK_SECONDS
+from metrics import registry, STAGE_SECONDS, ALERT_LATENCY_SECONDS, THREATS, CANCELS, ERRORS, LABEL_SKIPS
+from labels import LABEL_SPEECH_GATE, parse_labels, top_labels, has_speech, format_labels
+from services import services, WARM_UP_SERVICES
+from rate_limit import create_rate_limiter, TRUSTED_PROXY_DEPTH
+from housekeeping import Housekeeper, resident_memory_bytes
+from gps_track import (GpsTracks, distance_meters, LOCATION_UPDATES, LOCATION_UPDATE_INTERVAL,
+                       LOCATION_UPDATE_DURATION, LOCATION_UPDATE_SUBJECT, GPS_TRACK_MIN_MOVEMENT_METERS)
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    print(f"App imported in {IMPORT_SECONDS:.3f} seconds")
+    await message_bus.start()
+    await alert_outbox.start()
+    await event_log.start()
+    await housekeeper.start()
+    if USER_CACHE_KEYSPACE_INVALIDATION:
+        # Keep cached profiles consistent with writes from other workers
+        user_cache.listen_for_invalidations(redis_client)
+    # Speech-to-Text, Gemini, SendGrid and the audio chain are built in the background,
+    # /login and /ws are served in the meantime and anything else waits for its own client
+    warm_up = asyncio.create_task(services.warm_up()) if WARM_UP_SERVICES else None
+    print(f"Ready in {time.perf_counter() - _import_started:.3f} seconds")
+    yield
+    if warm_up is not None:
+        warm_up.cancel()
+    await message_bus.stop()
+    await alert_outbox.stop()
+    await event_log.stop()
+    await housekeeper.stop()
+    for task in list(location_updates.values()):
+        task.cancel()
+    user_cache.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 SECRET_KEY = os.environ.get('JWT_SECRET_KEY')
 ALGORITHM = "HS256"
-
-# Dictionary to store active WebSocket connections by user ID
-active_connections: Dict[str, WebSocket] = {}
-
-
+# Used for the alert text when the safe word was said, without revealing the safe word
+SAFE_WORD_EXPLANATION = "The user signalled that they are in danger and asked for help."
+# Sent when the safe word was said, or when Gemini can't write the alert, so help never waits on an LLM
+FALLBACK_ALERT_MESSAGE = ("Hi, I think I am in danger and I need your help. "
+                          "Please come and get me as soon as you can, my location is below.")
+
+# Active WebSocket connections by user ID
+connection_manager = ConnectionManager()
 auth_manager = AuthManager()
-
-async def process_message(message: str, gps: str, labels: str, user_id: str):
-    threat_response = detect_threat(message, labels, user_id)
-    if threat_response.get('threat_level') == '1':
-        print(f"Threat detected for user ")
+# Threats waiting for the user to cancel or confirm them
+confirmations = ConfirmationRegistry()
+# Reaches sockets and pending confirmations held by other workers/instances
+message_bus = create_message_bus(connection_manager.send, redis_host, redis_port,
+                                 resolve=confirmations.resolve)
+# Recent transcripts per user, the context detect_threat sees
+transcript_windows = TranscriptWindows()
+# Recent positions per user, updated by every fragment
+gps_tracks = GpsTracks()
+# Users whose contact is being sent their location after an alert
+location_updates: Dict[str, asyncio.Task] = {}
+
+
+async def process_message(user_id: str, fragments: list) -> Optional[dict]:
+    """
+    Evaluate the fragments received since the user's last evaluation.
+
+    Returns:
+        Optional[dict]: The threat response and latest gps if a threat was detected
+    """
+    # Judge the recent fragments together, so sentences split across fragments aren't missed
+    window = transcript_windows.get(user_id)
+    changed = False
+    for fragment in fragments:
+        changed = window.add(fragment.message, fragment.labels) or changed
+    if not changed:
+        # Nothing new was said, the last verdict still stands
+        return None
+    latest = fragments[-1]
+    gps = latest.gps
+    window_text = window.text()
+    if contains_safe_word(window_text, user_id):
+        # Safe word said, go straight to confirmation without waiting for Gemini
+        threat_response = {"threat_level": "1", "explanation": SAFE_WORD_EXPLANATION,
+                           "alert_message": FALLBACK_ALERT_MESSAGE}
+        source = "safe_word"
+    elif LABEL_SPEECH_GATE and all(fragment.speech is False for fragment in fragments):
+        # Whatever was transcribed, the phone's classifier heard nobody talking
+        LABEL_SKIPS.inc()
+        return None
+    else:
+        threat_response = await run_stage("detect_threat", detect_threat, window_text, window.labels(),
+                                         user_id)
+        source = "gemini"
+    event_log.record(user_id, "verdict", request_id=latest.request_id, source=source,
+                     threat_level=threat_response.get('threat_level'),
+                     explanation=threat_response.get('explanation'))
+    if threat_response.get('threat_level') != '1':
+        return None
+    return {"threat_response": threat_response, "gps": gps,
+            "request_id": latest.request_id, "received": latest.received}
+
+
+async def handle_threat(user_id: str, result: dict):
+    threat_response = result["threat_response"]
+    gps = result["gps"]
+    request_id = result["request_id"]
+    if user_id in confirmations:
+        print("Confirmation already pending for user, skipping.")
+        return
+    threatened_users.add(user_id)
+    try:
+        print(f"[{request_id}] Threat detected for user ")
+        confirmation = confirmations.open(user_id)
         change_threat_status(user_id, True)
-        await send_message_to_user(user_id, "Threat detected. Please confirm if you are in danger.")
-        print("Waiting for user confirmation...")
-        await asyncio.sleep(5)
-        if check_threat_status(user_id):
-            print("Threat confirmed. Sending help.")
-            notif_message = generate_notif_message_from_explanation(threat_response.get('explanation'))
-            alert_message = add_location_to_notification(notif_message, gps)
-            send_email_alert(user_id, alert_message)
+        # Delivery over the bus can wait for an acknowledgement, the window runs meanwhile
+        prompt = asyncio.create_task(send_message_to_user(user_id,
+                                                          "Threat detected. Please confirm if you are in danger."))
+        if confirmation is None:
+            # Never drop an alert because too many are pending
+            print("Too many pending confirmations, sending help without waiting.")
+            confirmed = True
         else:
-            print("Threat not confirmed. Cancelling.")
-    
+            print("Waiting for user confirmation...")
+            try:
+                with STAGE_SECONDS.time(stage="confirmation_wait"):
+                    confirmed = await confirmation.wait()
+            finally:
+                confirmations.close(confirmation)
+            if confirmed is None:
+                # Window closed, the threat stands unless it was cancelled on another instance
+                confirmed = check_threat_status(user_id)
+        # This context was handled, don't let it raise the same threat again
+        transcript_windows.reset(user_id)
+        event_log.record(user_id, "alert", request_id=request_id, alert_id=request_id,
+                         status="confirmed" if confirmed else "cancelled")
+        if confirmed:
+            print(f"[{request_id}] Threat confirmed. Sending help.")
+            THREATS.inc(outcome="confirmed")
+            # Gemini writes the alert together with the verdict, the safe word uses a fixed text
+            notif_message = threat_response.get('alert_message')
+            if not notif_message:
+                try:
+                    notif_message = await run_stage("generate_notif_message",
+                                                    generate_notif_message_from_explanation,
+                                                    threat_response.get('explanation'))
+                except Exception as e:
+                    ERRORS.inc(stage="generate_notif_message")
+                    print(f"[{request_id}] Error writing the alert, sending the fixed text: {e}")
+                    notif_message = FALLBACK_ALERT_MESSAGE
+            track = gps_tracks.summary(user_id)
+            alert_message = add_location_to_notification(notif_message, gps, track)
+            # Only queues the alert, the outbox delivers it without holding up this task
+            send_email_alert(user_id, alert_message, alert_id=request_id)
+            ALERT_LATENCY_SECONDS.observe(time.time() - result["received"])
+            if LOCATION_UPDATES:
+                start_location_updates(user_id, request_id, track)
+        else:
+            print(f"[{request_id}] Threat not confirmed. Cancelling.")
+            THREATS.inc(outcome="cancelled")
+        await prompt
+    finally:
+        threatened_users.discard(user_id)
+
+
+async def send_location_updates(user_id: str, alert_id: str, last_sent):
+    """
+    Email the contact the user's new position every LOCATION_UPDATE_INTERVAL seconds,
+    until the threat is cancelled or LOCATION_UPDATE_DURATION is over.
+
+    Args:
+        alert_id (str): The alert being followed up, each update gets its own id derived from it
+        last_sent: The track summary included in the alert, None if it had no location
+    """
+    deadline = time.time() + LOCATION_UPDATE_DURATION
+    updates = 0
+    try:
+        while time.time() < deadline:
+            await asyncio.sleep(LOCATION_UPDATE_INTERVAL)
+            # Cancelled through /cancel, possibly on another instance
+            if not check_threat_status(user_id):
+                break
+            track = gps_tracks.summary(user_id, since=last_sent.time if last_sent else None)
+            if track is None:
+                # No position since the last update
+                continue
+            if last_sent and distance_meters(last_sent.latest, track.latest) < GPS_TRACK_MIN_MOVEMENT_METERS:
+                continue
+            updates += 1
+            send_email_alert(user_id, format_location_update(track), alert_id=f"{alert_id}-location-{updates}",
+                             subject=LOCATION_UPDATE_SUBJECT)
+            event_log.record(user_id, "location_update", alert_id=alert_id,
+                             lat=track.latest[0], long=track.latest[1])
+            last_sent = track
+    except Exception as e:
+        ERRORS.inc(stage="location_update")
+        print(f"[{alert_id}] Error sending location updates: {e}")
+    finally:
+        if location_updates.get(user_id) is asyncio.current_task():
+            del location_updates[user_id]
+        print(f"[{alert_id}] Sent {updates} location updates")
+
+
+def start_location_updates(user_id: str, alert_id: str, track):
+    stop_location_updates(user_id)
+    location_updates[user_id] = asyncio.create_task(send_location_updates(user_id, alert_id, track))
+
+
+def stop_location_updates(user_id: str):
+    task = location_updates.pop(user_id, None)
+    if task is not None:
+        task.cancel()
+
+
+# Users being asked to confirm a threat or being alerted, their new fragments are not evaluated
+threatened_users: Set[str] = set()
+# At most one evaluation in flight per user, with a global cap
+evaluation_scheduler = EvaluationScheduler(
+    process_message, handle_threat,
+    is_busy=lambda user_id: user_id in threatened_users,
+    # Safe word fragments don't wait in line behind other users under load
+    is_urgent=lambda user_id, fragment: contains_safe_word(fragment.message, user_id))
+# Token buckets per user and per IP for uploads, logins and confirmations
+rate_limiter = create_rate_limiter(redis_client)
+
+
+def under_threat(user_id: str) -> bool:
+    """
+    Users being asked to confirm a threat, being alerted, or whose contact is receiving
+    location updates are never rate limited, whatever their app sends.
+    """
+    return user_id in threatened_users or user_id in confirmations or user_id in location_updates
+
+
+def client_ip(request: Request) -> Optional[str]:
+    # Entries before the ones our proxies appended are whatever the client put in the header
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded and TRUSTED_PROXY_DEPTH > 0:
+        entries = [entry.strip() for entry in forwarded.split(",")]
+        if len(entries) >= TRUSTED_PROXY_DEPTH:
+            return entries[-TRUSTED_PROXY_DEPTH]
+    return request.client.host if request.client else None
+
+
+def too_many_requests(retry_after: float) -> JSONResponse:
+    retry_after = max(math.ceil(retry_after), 1)
+    return JSONResponse(content={"error": "Too many requests", "retry_after": retry_after},
+                        status_code=429, headers={"Retry-After": str(retry_after)})
+
+async def prune_tokens() -> int:
+    return auth_manager.prune_expired()
+
+
+async def sweep_upload_files() -> int:
+    return await run_stage("housekeeping", sweep_upload_dir, check_temp_and_upload_folders())
+
+
+async def reap_sockets() -> int:
+    # Sockets that are gone without the receive loop noticing, or that stopped sending heartbeats
+    return await connection_manager.reap(max_idle=2 * WS_IDLE_TIMEOUT)
+
+
+async def cancel_stuck_tasks() -> int:
+    return evaluation_scheduler.cancel_stuck(EVALUATION_STUCK_SECONDS)
+
+
+async def prune_caches() -> int:
+    removed = transcript_windows.prune() + user_cache.prune() + rate_limiter.prune() + gps_tracks.prune()
+    # Don't build the recognizer just to clean it
+    if services.is_ready("recognizer"):
+        removed += get_recognizer().prune_sessions()
+    return removed
+
+
+# Keeps a long-running instance from slowly leaking memory, files and sockets
+housekeeper = Housekeeper()
+housekeeper.add("tokens", prune_tokens)
+housekeeper.add("upload_files", sweep_upload_files)
+housekeeper.add("sockets", reap_sockets)
+housekeeper.add("stuck_tasks", cancel_stuck_tasks)
+housekeeper.add("caches", prune_caches)
+
+registry.gauge("hearmesafe_active_websockets", "Open WebSocket connections on this instance",
+               lambda: len(connection_manager))
+registry.gauge("hearmesafe_evaluations_in_flight", "Users with an evaluation running",
+               lambda: evaluation_scheduler.stats()["in_flight"])
+registry.gauge("hearmesafe_evaluations_waiting", "Users waiting for an evaluation to start",
+               lambda: evaluation_scheduler.stats()["waiting"])
+registry.gauge("hearmesafe_evaluation_queued_fragments", "Fragments held for a user's next evaluation",
+               lambda: evaluation_scheduler.stats()["queued_fragments"])
+registry.gauge("hearmesafe_ws_send_queued", "Messages waiting in the WebSocket send queues",
+               lambda: sum(stats["queued"] for stats in connection_manager.stats()))
+registry.gauge("hearmesafe_pending_confirmations", "Threats waiting for the user to answer",
+               lambda: len(confirmations))
+registry.gauge("hearmesafe_oldest_pending_confirmation_seconds", "Age of the longest unanswered threat",
+               lambda: max((pending["age"] for pending in confirmations.pending()), default=0.0))
+registry.gauge("hearmesafe_alert_outbox_pending", "Alerts waiting to be delivered",
+               lambda: alert_outbox.stats()["pending"])
+registry.gauge("hearmesafe_event_log_queued", "Events waiting to be written to Redis",
+               lambda: event_log.stats()["queued"])
+registry.gauge("hearmesafe_refresh_tokens", "Refresh tokens held by AuthManager",
+               lambda: len(auth_manager.refresh_tokens))
+registry.gauge("hearmesafe_verified_tokens", "Verified access tokens cached by AuthManager",
+               lambda: len(auth_manager.verified_tokens))
+registry.gauge("hearmesafe_transcript_windows", "Users with a transcript window in memory",
+               lambda: len(transcript_windows))
+registry.gauge("hearmesafe_gps_tracks", "Users with a recent GPS track in memory",
+               lambda: len(gps_tracks))
+registry.gauge("hearmesafe_location_updates", "Alerts whose contact is being sent location updates",
+               lambda: len(location_updates))
+registry.gauge("hearmesafe_user_cache_entries", "User profiles in the cache",
+               lambda: len(user_cache))
+registry.gauge("hearmesafe_rate_limit_buckets", "Rate limit buckets held by this process",
+               lambda: len(rate_limiter.backend))
+registry.gauge("hearmesafe_streaming_sessions", "Open Speech-to-Text streaming sessions",
+               lambda: get_recognizer().session_count() if services.is_ready("recognizer") else 0)
+registry.gauge("hearmesafe_upload_dir_files", "Spilled uploads on disk",
+               lambda: len(os.listdir(check_temp_and_upload_folders())))
+registry.gauge("hearmesafe_resident_memory_bytes", "Resident memory of this process",
+               resident_memory_bytes)
+registry.gauge("hearmesafe_import_seconds", "Time taken to import the app on startup",
+               lambda: IMPORT_SECONDS)
+
+
+@app.route("/metrics", methods=["GET"])
+async def metrics(request: Request):
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 
 async def send_message_to_user(user_id: str, message: str):
-    websocket = active_connections.get(user_id)
-    if websocket:
-        try:
-            await websocket.send_text(message)
-            print('Message sent to user')
-        except Exception as e:
-            print(f"Error sending message: {e}")
+    # The socket may be held by another worker or instance
+    try:
+        delivered = await message_bus.publish(user_id, message)
+    except Exception as e:
+        print(f"Error sending message to user {user_id}: {e}")
+        return
+    if delivered:
+        print('Message delivered to user')
     else:
         print(f"No active WebSocket connection for user {user_id}")
 
@@ -100,9 +415,15 @@ async def login(request: Request):
     username = body.get("username")
     password = body.get("password")
 
+    ip = client_ip(request)
+    retry_after = rate_limiter.check_all([("login_ip", ip), ("login", f"{ip}:{username}" if username else None)])
+    if retry_after:
+        return too_many_requests(retry_after)
+
     user_id = user_id_from_username(username)
 
-    if not check_user(username, password):
+    # bcrypt runs in the worker pool so logins don't block uploads and WebSockets
+    if not await run_stage("check_user", check_user, username, password):
         return JSONResponse(content={"error": "Invalid username or password"}, status_code=401)
     # Assuming `auth_manager.generate_tokens()` returns a token dictionary
 
@@ -119,9 +440,51 @@ async def login(request: Request):
     return JSONResponse(content=to_return)
 
 
+async def ingest_fragment(user_id: str, audio, gps: Optional[str], labels,
+                          request_id: str, received: float, streamed: bool = False) -> str:
+    """
+    Transcribe a fragment and hand it to the threat evaluation, shared by /upload and the WebSocket.
+
+    Args:
+        audio: The fragment's WAV content or the path of a spilled upload
+        labels: The phone's sound classes, a JSON list of category/score or the legacy string
+        streamed (bool): The audio was already fed to the streaming recognizer, only collect the result
+
+    Returns:
+        str: The scheduler's outcome, "skipped" without voice activity or "failed"
+    """
+    labels = parse_labels(labels)
+    # Every fragment's position is kept, whether or not it gets evaluated
+    gps_tracks.add(user_id, gps, received)
+    try:
+        if streamed:
+            text_result = await run_stage("transcribe_audio", get_recognizer().collect, request_id)
+        else:
+            text_result = await run_stage("transcribe_audio", transcribe_audio, audio, user_id)
+        print(f"[{request_id}] {text_result} recognized in {time.time() - received} seconds")
+    except Exception as e:
+        ERRORS.inc(stage="transcribe_audio")
+        print(f"[{request_id}] Error transcribing audio: {e}")
+        text_result, evaluation = {}, "failed"
+    else:
+        if not text_result.get('voiced', True):
+            # Fragments without voice activity never reach Gemini
+            evaluation = "skipped"
+        else:
+            fragment = Fragment(text_result.get('text'), gps, top_labels(labels), request_id, received,
+                                speech=has_speech(labels))
+            evaluation = evaluation_scheduler.submit(user_id, fragment)  # Doesn't wait
+    event_log.record(user_id, "fragment", request_id=request_id, text=text_result.get('text'),
+                     confidence=text_result.get('confidence'), labels=format_labels(top_labels(labels)),
+                     gps=gps, evaluation=evaluation)
+    return evaluation
+
+
 @app.route("/upload", methods=["POST"])
 async def upload_audio(request: Request):
     start_upload = time.time()
+    # Follows the fragment through evaluation and alerting
+    request_id = secrets.token_hex(8)
     # verify jwt token
     auth_header = request.headers.get("Authorization")
 
@@ -136,9 +499,15 @@ async def upload_audio(request: Request):
     except ValueError:
         return JSONResponse(content={"error": "Invalid authorization header format"}, status_code=401)
     
-    user_id = await auth_manager.authenticate(token)
+    with STAGE_SECONDS.time(stage="auth"):
+        user_id = await auth_manager.authenticate(token)
     if not user_id:
         return JSONResponse(content={"error": "Invalid or expired token"}, status_code=401)
+    # Rejected before the form is parsed, so a looping app costs next to nothing
+    if not under_threat(user_id):
+        retry_after = rate_limiter.check_all([("upload", user_id), ("upload_ip", client_ip(request))])
+        if retry_after:
+            return too_many_requests(retry_after)
     # take the body from request
     body = await request.form()
 
@@ -149,31 +518,56 @@ async def upload_audio(request: Request):
     
     # Check if the temp and upload folders exist
     upload_dir = check_temp_and_upload_folders()
-    print(f'User {user_id} is trying to upload')
-    # Save the file to the server
-    file_path = await save_file(file, audio_file_name, upload_dir)
-    print(f'File saved to {file_path} in {time.time() - start_upload} seconds')
+    print(f'[{request_id}] User {user_id} is trying to upload')
+    # Keep the upload in memory unless it is too large
+    with STAGE_SECONDS.time(stage="save_file"):
+        audio = await read_upload(file, upload_dir)
+    file_path = audio if isinstance(audio, str) else None
 
     try:
-        text_result = transcribe_audio(file_path)
-        print(f"{text_result} recognized in {time.time() - start_upload} seconds")
-    
-    except Exception as e:
-        print(f"Error transcribing audio: {e}")
-    
+        evaluation = await ingest_fragment(user_id, audio, gps, labels, request_id, start_upload)
     finally:
-        delete_file(file_path)
-
-    print(f'file uploaded and recognized in {time.time() - start_upload} seconds')
-    asyncio.create_task(process_message(text_result.get('text'),gps, labels, user_id))  # Doesn't wait
+        release_upload(audio)
 
     return JSONResponse(content={
         "message": "File recognized successfully",
         "filename": file.filename,
         "audioFileName": audio_file_name,
-        "file_path": file_path
+        "file_path": file_path,
+        "evaluation": evaluation,
+        "request_id": request_id
     })
 
+@app.route("/events", methods=["GET"])
+async def events(request: Request):
+    # verify jwt token
+    auth_header = request.headers.get("Authorization")
+    if not auth_header:
+        return JSONResponse(content={"error": "Missing authentication data"}, status_code=401)
+    
+    # Split the "Bearer <token>" format to get the token part
+    try:
+        token_type, token = auth_header.split(" ")
+        if token_type.lower() != "bearer":
+            raise ValueError("Incorrect token type")
+    except ValueError:
+        return JSONResponse(content={"error": "Invalid authorization header format"}, status_code=401)
+    
+    user_id = await auth_manager.authenticate(token)
+    if not user_id:
+        return JSONResponse(content={"error": "Invalid or expired token"}, status_code=401)
+    try:
+        limit = min(max(int(request.query_params.get("limit", 50)), 1), 500)
+    except ValueError:
+        return JSONResponse(content={"error": "limit must be a number"}, status_code=400)
+    # Pass back the previous page's "next" to keep going further into the past
+    before = request.query_params.get("before")
+    try:
+        user_events, next_cursor = event_log.read(user_id, before=before, limit=limit)
+    except Exception as e:
+        return JSONResponse(content={"error": f"Error reading events: {e}"}, status_code=400)
+    return JSONResponse(content={"events": user_events, "next": next_cursor})
+
 @app.route("/cancel", methods=["POST"])
 async def cancel_threat(request: Request):
     # verify jwt token
@@ -192,10 +586,94 @@ async def cancel_threat(request: Request):
     user_id = await auth_manager.authenticate(token)
     if not user_id:
         return JSONResponse(content={"error": "Invalid or expired token"}, status_code=401)
+    if not under_threat(user_id):
+        retry_after = rate_limiter.check("alert", user_id)
+        if retry_after:
+            return too_many_requests(retry_after)
     print(f'User is trying to cancel the threat.')
     change_threat_status(user_id, False)
+    # A window closing on another instance reads isThreat anyway, so the answer only
+    # ends it sooner and the request doesn't wait for an acknowledgement
+    await message_bus.resolve(user_id, False, wait=False)
+    stop_location_updates(user_id)
+    CANCELS.inc()
     return JSONResponse(content={"message": "Threat cancelled successfully"})
 
+@app.route("/confirm", methods=["POST"])
+async def confirm_threat(request: Request):
+    # verify jwt token
+    auth_header = request.headers.get("Authorization")
+    if not auth_header:
+        return JSONResponse(content={"error": "Missing authentication data"}, status_code=401)
+    
+    # Split the "Bearer <token>" format to get the token part
+    try:
+        token_type, token = auth_header.split(" ")
+        if token_type.lower() != "bearer":
+            raise ValueError("Incorrect token type")
+    except ValueError:
+        return JSONResponse(content={"error": "Invalid authorization header format"}, status_code=401)
+    
+    user_id = await auth_manager.authenticate(token)
+    if not user_id:
+        return JSONResponse(content={"error": "Invalid or expired token"}, status_code=401)
+    if not under_threat(user_id):
+        retry_after = rate_limiter.check("alert", user_id)
+        if retry_after:
+            return too_many_requests(retry_after)
+    print('User confirmed the threat.')
+    # Send the alert now instead of waiting for the window to close
+    if not await message_bus.resolve(user_id, True):
+        return JSONResponse(content={"error": "No threat waiting for confirmation"}, status_code=404)
+    return JSONResponse(content={"message": "Threat confirmed successfully"})
+
+
+async def receive_audio_frame(connection, uploads: FragmentAssembler, message: dict):
+    data = message.get("bytes")
+    if not data:
+        return
+    try:
+        header, chunk = parse_frame(data)
+        fragment = uploads.add(header, chunk)
+    except FrameError as e:
+        connection.send(json.dumps({"type": "error", "error": str(e)}))
+        return
+    if fragment.chunks == 1 and not under_threat(connection.user_id):
+        # Checked on the first chunk, so a throttled fragment never reaches Speech-to-Text
+        retry_after = rate_limiter.check("upload", connection.user_id)
+        if retry_after:
+            fragment.rejected = True
+            connection.send(json.dumps({"type": "error", "seq": fragment.seq, "error": "Too many requests",
+                                        "retry_after": max(math.ceil(retry_after), 1)}))
+    if fragment.rejected:
+        return
+    # Start Speech-to-Text before the fragment is complete. Conditioning and VAD need
+    # the whole fragment, so this only happens when they are off. The recognizer is
+    # never built here on the event loop, until warm-up has built it fragments are sent whole.
+    if not PREPROCESS_AUDIO and chunk and services.is_ready("recognizer"):
+        first = fragment.chunks == 1
+        if first or fragment.streamed:
+            fragment.streamed = get_recognizer().push(chunk, connection.user_id, fragment.request_id,
+                                                        first=first)
+    if not fragment.complete:
+        return
+    # Flow control: while too many fragments of this phone are in flight, stop reading
+    # the socket so the backlog stays on the client
+    await uploads.slots.acquire()
+    uploads.track(asyncio.create_task(process_audio_fragment(connection, uploads, fragment)))
+
+
+async def process_audio_fragment(connection, uploads: FragmentAssembler, fragment: PartialFragment):
+    try:
+        print(f'[{fragment.request_id}] User {connection.user_id} uploaded fragment {fragment.seq} over WebSocket')
+        evaluation = await ingest_fragment(connection.user_id, memoryview(fragment.audio), fragment.gps,
+                                           fragment.labels, fragment.request_id, fragment.received,
+                                           streamed=fragment.streamed)
+        connection.send(json.dumps({"type": "ack", "seq": fragment.seq,
+                                    "request_id": fragment.request_id, "evaluation": evaluation}))
+    finally:
+        uploads.slots.release()
+
 
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket):
@@ -203,31 +681,33 @@ async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     print("Websocket connection accepted")
 
-    user_id = websocket.path_params.get("user_id")
-    active_connections[user_id] = websocket
-
-    # Initial authentication
-    auth_message = await websocket.receive_text()
-    auth_data = json.loads(auth_message)
-    
-    user_id = await auth_manager.authenticate(auth_data.get('token'))
-    if not user_id:
+    # Initial authentication, the socket is only registered once it succeeds
+    user_id = await connection_manager.authenticate(websocket, auth_manager.authenticate)
+    if not user_id or user_id != websocket.path_params.get("user_id"):
         await websocket.close(code=1008, reason="Authentication failed")
         return
 
+    connection = await connection_manager.register(user_id, websocket)
+    uploads = FragmentAssembler()
+
+    async def on_message(connection, message: dict):
+        await receive_audio_frame(connection, uploads, message)
+
     try:
-        # Handle messages
-        while True:
-            await asyncio.sleep(0)  # Non-blocking wait
+        # Handle messages, binary frames carry audio fragments
+        await connection_manager.serve(connection, on_message)
 
     except WebSocketDisconnect as e:
         print(f"WebSocket disconnected with code {e.code} and reason {e.reason}")
         
     finally:
         # This ensures the connection is closed properly even if there are other exceptions
-        if user_id in active_connections:
-            del active_connections[user_id]
-        await websocket.close()
+        uploads.drop_unfinished()
+        await connection_manager.unregister(connection)
+        # Acks for these go to the closed connection and are dropped, the evaluation is what matters
+        await uploads.drain()
+        if connection_manager.get(user_id) is None and services.is_ready("recognizer"):
+            get_recognizer().close_stream(user_id)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import os
+import secrets
+from typing import Callable, Dict, Optional
+
+import redis.asyncio
+
+# "local" for a single process, "redis" to reach sockets held by other workers/instances
+MESSAGE_BUS = os.environ.get("MESSAGE_BUS", "local")
+MESSAGE_BUS_CHANNEL = os.environ.get("MESSAGE_BUS_CHANNEL", "ws:messages")
+# How long to wait for the instance holding the socket to acknowledge delivery
+MESSAGE_BUS_ACK_TIMEOUT = float(os.environ.get("MESSAGE_BUS_ACK_TIMEOUT", 2))
+# Wait before subscribing again after the pub/sub connection dropped
+MESSAGE_BUS_RECONNECT_DELAY = float(os.environ.get("MESSAGE_BUS_RECONNECT_DELAY", 1))
+
+# deliver(user_id, message) -> True if the user has a socket on this instance
+Deliver = Callable[[str, str], bool]
+# resolve(user_id, confirmed) -> True if the user's threat confirmation is pending on this instance
+Resolve = Callable[[str, bool], bool]
+
+
+class LocalMessageBus:
+    """Delivers only to sockets of this process, for single node and test runs."""
+
+    def __init__(self, deliver: Deliver, resolve: Resolve = lambda user_id, confirmed: False):
+        self._deliver = deliver
+        self._resolve = resolve
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, user_id: str, message: str) -> bool:
+        return self._deliver(user_id, message)
+
+    async def resolve(self, user_id: str, confirmed: bool, wait: bool = True) -> bool:
+        return self._resolve(user_id, confirmed)
+
+
+class RedisMessageBus:
+    """
+    Fans messages out over Redis pub/sub to whichever instance holds the user's socket,
+    and /cancel or /confirm answers to whichever instance is waiting for them.
+    The instance that handled it acknowledges on the sender's own ack channel.
+    """
+
+    def __init__(self, deliver: Deliver, resolve: Resolve = lambda user_id, confirmed: False,
+                 host: str = None, port: int = None,
+                 client: Optional[redis.asyncio.Redis] = None,
+                 channel: str = MESSAGE_BUS_CHANNEL, ack_timeout: float = MESSAGE_BUS_ACK_TIMEOUT):
+        self._deliver = deliver
+        self._resolve = resolve
+        self._client = client or redis.asyncio.StrictRedis(host=host, port=port)
+        self.channel = channel
+        self.instance_id = secrets.token_hex(8)
+        self.ack_channel = f"{channel}:ack:{self.instance_id}"
+        self.ack_timeout = ack_timeout
+        self._acks: Dict[str, asyncio.Future] = {}
+        self._pubsub = None
+        self._listener = None
+        self._stopped = False
+
+    async def _subscribe(self):
+        self._pubsub = self._client.pubsub()
+        await self._pubsub.subscribe(self.channel, self.ack_channel)
+
+    async def start(self):
+        await self._subscribe()
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        # The cancellation alone can be lost inside the client's listen(), don't resubscribe after it
+        self._stopped = True
+        if self._listener is not None:
+            self._listener.cancel()
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe()
+            await self._pubsub.aclose()
+
+    async def _listen(self):
+        # Without this loop one dropped connection would silently end cross-instance delivery
+        while not self._stopped:
+            try:
+                async for item in self._pubsub.listen():
+                    if item["type"] == "message":
+                        await self._handle(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Message bus connection lost: {e}")
+            await asyncio.sleep(MESSAGE_BUS_RECONNECT_DELAY)
+            if self._stopped:
+                return
+            try:
+                await self._pubsub.aclose()
+                await self._subscribe()
+                print("Message bus resubscribed")
+            except Exception as e:
+                print(f"Error resubscribing to the message bus: {e}")
+
+    async def _handle(self, item: dict):
+        try:
+            data = json.loads(item["data"])
+            channel = item["channel"].decode("utf-8") if isinstance(item["channel"], bytes) else item["channel"]
+            if channel == self.ack_channel:
+                future = self._acks.get(data["id"])
+                if future is not None and not future.done():
+                    future.set_result(True)
+                return
+            if data["origin"] == self.instance_id:
+                return
+            if data.get("type") == "resolve":
+                handled = self._resolve(data["user_id"], data["confirmed"])
+            else:
+                handled = self._deliver(data["user_id"], data["message"])
+            if handled:
+                await self._client.publish(data["reply_to"], json.dumps({"id": data["id"]}))
+        except Exception as e:
+            print(f"Error handling bus message: {e}")
+
+    async def _request(self, payload: dict, wait: bool = True) -> bool:
+        """
+        Publish to the other instances, returns True once one of them acknowledged.
+        Without wait it returns False right after publishing.
+        """
+        message_id = secrets.token_hex(8)
+        future = asyncio.get_running_loop().create_future()
+        self._acks[message_id] = future
+        try:
+            await self._client.publish(self.channel, json.dumps({"id": message_id,
+                                                                 "origin": self.instance_id,
+                                                                 "reply_to": self.ack_channel,
+                                                                 **payload}))
+            if not wait:
+                return False
+            await asyncio.wait_for(future, self.ack_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._acks.pop(message_id, None)
+
+    async def publish(self, user_id: str, message: str) -> bool:
+        """Deliver locally if possible, otherwise over Redis, returns True once acknowledged."""
+        if self._deliver(user_id, message):
+            return True
+        return await self._request({"user_id": user_id, "message": message})
+
+    async def resolve(self, user_id: str, confirmed: bool, wait: bool = True) -> bool:
+        """
+        Answer the user's pending confirmation on whichever instance is waiting for it.
+
+        Args:
+            wait (bool): Wait for the instance to acknowledge, otherwise only a local answer returns True
+        """
+        if self._resolve(user_id, confirmed):
+            return True
+        return await self._request({"type": "resolve", "user_id": user_id, "confirmed": confirmed}, wait=wait)
+
+
+def create_message_bus(deliver: Deliver, host: str = None, port: int = None,
+                       resolve: Resolve = lambda user_id, confirmed: False):
+    if MESSAGE_BUS == "redis":
+        return RedisMessageBus(deliver, resolve, host=host, port=port)
+    return LocalMessageBus(deliver, resolve)
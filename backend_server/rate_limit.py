@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Sequence
+
+from metrics import registry
+
+# "local" keeps the buckets in this process, "redis" shares them between workers/instances
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "local")
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT", "True") == "True"
+# Buckets kept by the local limiter, least recently used keys are dropped first
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100000))
+# Position from the end of X-Forwarded-For of the address our own proxies saw. App Engine's
+# front end appends "<client>, <load balancer>" after whatever the client sent, so it is the
+# second from last. 0 ignores the header and uses the peer address.
+TRUSTED_PROXY_DEPTH = int(os.environ.get("TRUSTED_PROXY_DEPTH", 2))
+
+# Budget per scope as "<tokens per second>/<burst>", each one can be overridden with
+# <SCOPE>_RATE_LIMIT, e.g. UPLOAD_RATE_LIMIT=0.5/10. A rate of 0 disables the budget.
+DEFAULT_RATE_LIMITS = {
+    # The app sends one fragment every 5 seconds
+    "upload": "1/10",
+    # Phones behind the same carrier NAT share an address
+    "upload_ip": "20/200",
+    # bcrypt is expensive, a few attempts then one every 10 seconds, per address and username
+    # so nobody else can lock a user out
+    "login": "0.1/5",
+    "login_ip": "1/20",
+    # /confirm and /cancel outside of a threat
+    "alert": "0.2/5",
+}
+
+THROTTLED = registry.counter("hearmesafe_throttled_total", "Requests rejected by the rate limiter", ["scope"])
+
+
+class Budget(NamedTuple):
+    rate: float
+    burst: float
+
+
+def parse_budget(value: str) -> Budget:
+    rate, burst = value.split("/")
+    return Budget(float(rate), float(burst))
+
+
+budgets: Dict[str, Budget] = {
+    scope: parse_budget(os.environ.get(f"{scope.upper()}_RATE_LIMIT", default))
+    for scope, default in DEFAULT_RATE_LIMITS.items()
+}
+
+
+class LocalRateLimiter:
+    """Token buckets in this process."""
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        # key: (tokens, last refill)
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def prune(self, max_idle: float) -> int:
+        """Drop buckets untouched for max_idle seconds, they would be full again anyway."""
+        cutoff = time.monotonic() - max_idle
+        with self._lock:
+            idle = [key for key, (_, last) in self._buckets.items() if last < cutoff]
+            for key in idle:
+                del self._buckets[key]
+        return len(idle)
+
+    def acquire(self, key: str, budget: Budget, cost: float = 1) -> float:
+        """Take cost tokens, returns 0 if allowed or the seconds until enough tokens are back."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (budget.burst, now))
+            tokens = min(budget.burst, tokens + (now - last) * budget.rate)
+            retry_after = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                retry_after = (cost - tokens) / budget.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return retry_after
+
+
+# Refill and take in one round trip, so concurrent workers can't both spend the last token
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "last")
+local tokens = tonumber(bucket[1]) or burst
+local last = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - last, 0) * rate)
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "last", tostring(now))
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(retry_after)
+"""
+
+
+class RedisRateLimiter:
+    """Token buckets in Redis, shared by every worker and instance."""
+
+    def __init__(self, redis_client):
+        self._script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def __len__(self) -> int:
+        # Buckets live in Redis and expire there
+        return 0
+
+    def prune(self, max_idle: float) -> int:
+        return 0
+
+    def acquire(self, key: str, budget: Budget, cost: float = 1) -> float:
+        return float(self._script(keys=[f"ratelimit:{key}"], args=[budget.rate, budget.burst, time.time(), cost]))
+
+
+class RateLimiter:
+    """Applies the per-scope budgets to a request's keys."""
+
+    def __init__(self, backend, enabled: bool = RATE_LIMIT_ENABLED):
+        self.backend = backend
+        self.enabled = enabled
+
+    def check(self, scope: str, key: Optional[str]) -> float:
+        """
+        Take a token from the scope's bucket for key.
+
+        Returns:
+            float: 0 if the request may go ahead, otherwise the seconds to wait
+        """
+        budget = budgets.get(scope)
+        if not self.enabled or not key or budget is None or budget.rate <= 0:
+            return 0.0
+        try:
+            retry_after = self.backend.acquire(f"{scope}:{key}", budget)
+        except Exception as e:
+            # Never turn a Redis problem into rejected requests
+            print(f"Error checking rate limit: {e}")
+            return 0.0
+        if retry_after:
+            THROTTLED.inc(scope=scope)
+        return retry_after
+
+    def prune(self) -> int:
+        """Drop buckets that have refilled completely under every budget."""
+        refill = max((budget.burst / budget.rate for budget in budgets.values() if budget.rate > 0), default=0)
+        return self.backend.prune(refill)
+
+    def check_all(self, checks: Sequence[tuple]) -> float:
+        """Check several (scope, key) buckets, returns the longest wait."""
+        return max((self.check(scope, key) for scope, key in checks), default=0.0)
+
+
+def create_rate_limiter(redis_client) -> RateLimiter:
+    if RATE_LIMIT_BACKEND == "redis":
+        return RateLimiter(RedisRateLimiter(redis_client))
+    return RateLimiter(LocalRateLimiter())
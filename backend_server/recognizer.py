@@ -0,0 +1,280 @@
+import itertools
+import os
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from services import services
+
+if TYPE_CHECKING:
+    from google.cloud import speech
+
+SAMPLE_RATE_HERTZ = 16000
+LANGUAGE_CODE = "en-US"
+SPEECH_CLIENT_POOL_SIZE = int(os.environ.get("SPEECH_CLIENT_POOL_SIZE", 4))
+# When enabled, each fragment is its own streaming utterance, recognized while its audio arrives
+STREAMING_RECOGNITION = os.environ.get("STREAMING_RECOGNITION", "False") == "True"
+# How long to wait for the final results once all of a fragment's audio was sent
+STREAMING_RESULT_TIMEOUT = float(os.environ.get("STREAMING_RESULT_TIMEOUT", 5.0))
+# Google closes streaming sessions after ~305 seconds, a fragment still open after this was abandoned
+STREAMING_SESSION_MAX_SECONDS = 280
+# Audio is sent in requests of 100 ms, as Google recommends for streaming
+STREAMING_CHUNK_BYTES = SAMPLE_RATE_HERTZ * 2 // 10
+# Each session holds a thread and a gRPC stream, beyond this fragments are transcribed whole
+MAX_STREAMING_SESSIONS = int(os.environ.get("MAX_STREAMING_SESSIONS", 16))
+
+NO_SPEECH = {'text': "No speech detected", 'confidence': 0.0}
+
+
+def recognition_config() -> "speech.RecognitionConfig":
+    from google.cloud import speech
+    return speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+        sample_rate_hertz=SAMPLE_RATE_HERTZ,
+        language_code=LANGUAGE_CODE,
+    )
+
+
+def wav_payload(chunk: bytes) -> bytes:
+    """
+    The audio after the WAV header of a fragment's first chunk, streaming recognition only
+    accepts raw LINEAR16 frames. The header's data size isn't trusted, a phone writing as it
+    records may not know it yet.
+    """
+    chunk = bytes(chunk)
+    if chunk[:4] != b"RIFF" or chunk[8:12] != b"WAVE":
+        return chunk
+    offset = 12
+    while offset + 8 <= len(chunk):
+        chunk_id, size = chunk[offset:offset + 4], int.from_bytes(chunk[offset + 4:offset + 8], "little")
+        if chunk_id == b"data":
+            return chunk[offset + 8:]
+        offset += 8 + size + (size & 1)
+    return b""
+
+
+class SpeechClientPool:
+    """Process-wide pool of SpeechClients, each keeping its gRPC channel open."""
+
+    def __init__(self, size: int = SPEECH_CLIENT_POOL_SIZE):
+        from google.cloud import speech
+        self._clients = [speech.SpeechClient() for _ in range(max(size, 1))]
+        self._cycle = itertools.cycle(self._clients)
+        self._lock = threading.Lock()
+
+    def get(self) -> "speech.SpeechClient":
+        with self._lock:
+            return next(self._cycle)
+
+
+class StreamingSession:
+    """
+    One streaming_recognize call carrying a single fragment. Results belong to that
+    fragment only, however late they arrive or whatever else the user is uploading.
+    """
+
+    def __init__(self, client: "speech.SpeechClient", user_id: Optional[str] = None):
+        self.user_id = user_id
+        self.started = time.monotonic()
+        self.closed = False
+        self._client = client
+        self._audio: queue.Queue = queue.Queue()
+        self._results: List[dict] = []
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def expired(self) -> bool:
+        return self.closed or time.monotonic() - self.started > STREAMING_SESSION_MAX_SECONDS
+
+    def _requests(self):
+        from google.cloud import speech
+        while True:
+            chunk = self._audio.get()
+            if chunk is None:
+                return
+            yield speech.StreamingRecognizeRequest(audio_content=chunk)
+
+    def _run(self):
+        from google.cloud import speech
+        config = speech.StreamingRecognitionConfig(config=recognition_config(), interim_results=False)
+        try:
+            responses = self._client.streaming_recognize(config=config, requests=self._requests())
+            for response in responses:
+                for result in response.results:
+                    if result.is_final and result.alternatives:
+                        self._results.append({'text': result.alternatives[0].transcript,
+                                              'confidence': result.alternatives[0].confidence})
+        except Exception as e:
+            print(f"Streaming recognition stopped: {e}")
+        finally:
+            self.closed = True
+            self._done.set()
+
+    def push(self, pcm: bytes):
+        """Send audio in 100 ms requests without waiting for results."""
+        pcm = bytes(pcm)
+        for offset in range(0, len(pcm), STREAMING_CHUNK_BYTES):
+            self._audio.put(pcm[offset:offset + STREAMING_CHUNK_BYTES])
+
+    def result(self, timeout: float = STREAMING_RESULT_TIMEOUT) -> dict:
+        """End the fragment's audio and wait for its final results."""
+        self.close()
+        if not self._done.wait(timeout):
+            print(f"No final streaming result within {timeout} seconds")
+        results = list(self._results)
+        if not results:
+            return dict(NO_SPEECH)
+        return {'text': " ".join(result['text'].strip() for result in results),
+                'confidence': min(result['confidence'] for result in results)}
+
+    def close(self):
+        self._audio.put(None)
+
+
+class CloudRecognizer:
+    """Google Speech-to-Text backed recognizer, one-shot or streaming per fragment."""
+
+    def __init__(self, pool_size: int = SPEECH_CLIENT_POOL_SIZE, streaming: bool = STREAMING_RECOGNITION,
+                 max_sessions: int = MAX_STREAMING_SESSIONS):
+        self.pool = SpeechClientPool(pool_size)
+        self.streaming = streaming
+        self.max_sessions = max_sessions
+        self._sessions: Dict[str, StreamingSession] = {}
+        self._lock = threading.Lock()
+
+    def recognize(self, content: bytes) -> dict:
+        from google.cloud import speech
+        audio = speech.RecognitionAudio(content=bytes(content))
+        response = self.pool.get().recognize(config=recognition_config(), audio=audio)
+        try:
+            return {'text': response.results[0].alternatives[0].transcript,
+                    'confidence': response.results[0].alternatives[0].confidence}
+        except Exception:
+            return dict(NO_SPEECH)
+
+    def transcribe(self, content: bytes, user_id: Optional[str] = None) -> dict:
+        # The whole fragment is already here, streaming it would only add a thread and a stream
+        return self.recognize(content)
+
+    def push(self, chunk: bytes, user_id: str, fragment_id: str, first: bool = False) -> bool:
+        """
+        Feed part of a fragment to its streaming utterance while the rest is still arriving.
+
+        Args:
+            chunk (bytes): The next piece of the fragment's WAV
+            user_id (str): The user the fragment belongs to
+            fragment_id (str): Identifies the fragment, its results are read with collect(fragment_id)
+            first (bool): Whether the chunk starts the fragment and holds the WAV header
+
+        Returns:
+            bool: False without streaming recognition or with max_sessions open,
+                transcribe the whole fragment instead
+        """
+        if not self.streaming:
+            return False
+        with self._lock:
+            session = self._sessions.get(fragment_id)
+            if session is None:
+                if len(self._sessions) >= self.max_sessions:
+                    return False
+                session = StreamingSession(self.pool.get(), user_id)
+                self._sessions[fragment_id] = session
+        session.push(wav_payload(chunk) if first else chunk)
+        return True
+
+    def collect(self, fragment_id: str) -> dict:
+        """Results of the audio pushed for this fragment, once all of it was pushed."""
+        with self._lock:
+            session = self._sessions.pop(fragment_id, None)
+        return session.result() if session is not None else dict(NO_SPEECH)
+
+    def prune_sessions(self) -> int:
+        """Close sessions of fragments that never completed, e.g. dropped or on a closed socket."""
+        with self._lock:
+            expired = [fragment_id for fragment_id, session in self._sessions.items() if session.expired]
+            sessions = [self._sessions.pop(fragment_id) for fragment_id in expired]
+        for session in sessions:
+            session.close()
+        return len(sessions)
+
+    def session_count(self) -> int:
+        return len(self._sessions)
+
+    def close_stream(self, user_id: str):
+        """Close the user's unfinished fragments, their socket is gone."""
+        with self._lock:
+            fragment_ids = [fragment_id for fragment_id, session in self._sessions.items()
+                            if session.user_id == user_id]
+            sessions = [self._sessions.pop(fragment_id) for fragment_id in fragment_ids]
+        for session in sessions:
+            session.close()
+
+
+class FakeRecognizer:
+    """
+    Local stand-in for tests, returns canned transcripts without calling Google.
+    With streaming, pushed audio is kept per fragment and collect() transcribes it.
+    """
+
+    def __init__(self, transcripts: Optional[List[str]] = None, confidence: float = 1.0, latency: float = 0.0,
+                 streaming: bool = False, max_sessions: int = MAX_STREAMING_SESSIONS):
+        self._transcripts = itertools.cycle(transcripts or [NO_SPEECH['text']])
+        self.confidence = confidence
+        self.latency = latency
+        self.streaming = streaming
+        self.max_sessions = max_sessions
+        self.calls = 0
+        # fragment_id: (user_id, audio pushed so far)
+        self._sessions: Dict[str, tuple] = {}
+
+    def transcribe(self, content: bytes, user_id: Optional[str] = None) -> dict:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return {'text': next(self._transcripts), 'confidence': self.confidence}
+
+    def push(self, chunk: bytes, user_id: str, fragment_id: str, first: bool = False) -> bool:
+        if not self.streaming:
+            return False
+        if fragment_id not in self._sessions and len(self._sessions) >= self.max_sessions:
+            return False
+        _, audio = self._sessions.setdefault(fragment_id, (user_id, bytearray()))
+        audio += wav_payload(chunk) if first else chunk
+        return True
+
+    def collect(self, fragment_id: str) -> dict:
+        session = self._sessions.pop(fragment_id, None)
+        if session is None:
+            return dict(NO_SPEECH)
+        return self.transcribe(bytes(session[1]), session[0])
+
+    def prune_sessions(self) -> int:
+        return 0
+
+    def session_count(self) -> int:
+        return len(self._sessions)
+
+    def close_stream(self, user_id: str):
+        for fragment_id in [fragment_id for fragment_id, session in self._sessions.items() if session[0] == user_id]:
+            del self._sessions[fragment_id]
+
+
+# Speech-to-Text is imported and its channels opened on first use or during warm-up
+services.register("recognizer", CloudRecognizer)
+
+
+def init_recognizer():
+    """Create the process-wide recognizer."""
+    return services.get("recognizer")
+
+
+def set_recognizer(recognizer):
+    """Replace the recognizer, e.g. with a FakeRecognizer in tests."""
+    services.set("recognizer", recognizer)
+
+
+def get_recognizer():
+    return services.get("recognizer")
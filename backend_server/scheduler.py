@@ -0,0 +1,175 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from labels import Labels
+from metrics import ERRORS, EVALUATION_FRAGMENTS, EVALUATIONS
+from transcript_window import TRANSCRIPT_WINDOW_SIZE
+
+# Evaluations (safe word + Gemini) running at the same time across all users
+MAX_CONCURRENT_EVALUATIONS = int(os.environ.get("MAX_CONCURRENT_EVALUATIONS", 32))
+# Users with an evaluation task in flight, beyond this new users wait in line for one to finish
+MAX_RUNNING_EVALUATIONS = int(os.environ.get("MAX_RUNNING_EVALUATIONS",
+                                             os.environ.get("MAX_QUEUED_EVALUATIONS", 1000)))
+# Fragments kept per user for the next evaluation, the transcript window never uses more
+MAX_PENDING_FRAGMENTS = int(os.environ.get("MAX_PENDING_FRAGMENTS", TRANSCRIPT_WINDOW_SIZE))
+# An evaluation, including the confirmation window and queuing the alert, running longer than this is stuck
+EVALUATION_STUCK_SECONDS = float(os.environ.get("EVALUATION_STUCK_SECONDS", 120))
+
+
+class Fragment(NamedTuple):
+    message: Optional[str]
+    gps: Optional[str]
+    labels: Labels
+    # Carried from the upload so each alert can be traced back to its fragment
+    request_id: str
+    received: float
+    # Whether the phone heard speech in the fragment, None without labels
+    speech: Optional[bool] = None
+
+
+class EvaluationScheduler:
+    """
+    Runs at most one threat evaluation per user. Fragments that arrive while one is in
+    flight are merged into the next evaluation, and users that are already being
+    asked to confirm a threat or alerted are skipped. Under load new users wait in
+    line, except for urgent fragments (the safe word), which are always started.
+    """
+
+    def __init__(self,
+                 evaluate: Callable[[str, List[Fragment]], Awaitable[Optional[dict]]],
+                 on_threat: Callable[[str, dict], Awaitable[None]],
+                 is_busy: Callable[[str], bool] = lambda user_id: False,
+                 is_urgent: Callable[[str, Fragment], bool] = lambda user_id, fragment: False,
+                 max_concurrent: int = MAX_CONCURRENT_EVALUATIONS,
+                 max_running: int = MAX_RUNNING_EVALUATIONS,
+                 max_pending: int = MAX_PENDING_FRAGMENTS):
+        self._evaluate = evaluate
+        self._on_threat = on_threat
+        self._is_busy = is_busy
+        self._is_urgent = is_urgent
+        self.max_concurrent = max_concurrent
+        self.max_running = max_running
+        self.max_pending = max_pending
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._running: Dict[str, asyncio.Task] = {}
+        self._pending: Dict[str, List[Fragment]] = {}
+        # Users waiting for a task, oldest first, with their fragments
+        self._waiting: "OrderedDict[str, List[Fragment]]" = OrderedDict()
+        # user_id: when the current evaluation started
+        self._started: Dict[str, float] = {}
+        self.submitted = 0
+        self.merged = 0
+        self.skipped = 0
+        self.queued = 0
+        self.failed = 0
+        self.completed = 0
+
+    def submit(self, user_id: str, fragment: Fragment) -> str:
+        """
+        Schedule a fragment for evaluation.
+
+        Returns:
+            str: "scheduled", "merged", "skipped" (threat already being handled)
+            or "queued" (waiting for other users' evaluations to finish)
+        """
+        self.submitted += 1
+        if self._is_busy(user_id):
+            self.skipped += 1
+            return self._outcome("skipped")
+        if user_id in self._running:
+            self._add(self._pending.setdefault(user_id, []), fragment)
+            self.merged += 1
+            return self._outcome("merged")
+        # Checked before the cap, so the safe word is never held up by other users
+        urgent = self._is_urgent(user_id, fragment)
+        if user_id in self._waiting and not urgent:
+            self._add(self._waiting[user_id], fragment)
+            self.merged += 1
+            return self._outcome("merged")
+        fragments = self._waiting.pop(user_id, [])
+        self._add(fragments, fragment)
+        if len(self._running) >= self.max_running and not urgent:
+            self._waiting[user_id] = fragments
+            self.queued += 1
+            return self._outcome("queued")
+        self._start(user_id, fragments)
+        return self._outcome("scheduled")
+
+    @staticmethod
+    def _outcome(outcome: str) -> str:
+        EVALUATION_FRAGMENTS.inc(outcome=outcome)
+        return outcome
+
+    def _add(self, fragments: List[Fragment], fragment: Fragment):
+        """Append a fragment, keeping only the most recent max_pending of them."""
+        fragments.append(fragment)
+        del fragments[:-self.max_pending]
+
+    def _start(self, user_id: str, fragments: List[Fragment]):
+        self._running[user_id] = asyncio.create_task(self._run(user_id, fragments))
+
+    def _start_waiting(self):
+        while self._waiting and len(self._running) < self.max_running:
+            user_id, fragments = self._waiting.popitem(last=False)
+            self._start(user_id, fragments)
+
+    async def _run(self, user_id: str, fragments: List[Fragment]):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        try:
+            while fragments:
+                self._started[user_id] = time.monotonic()
+                try:
+                    if any(self._is_urgent(user_id, fragment) for fragment in fragments):
+                        # The safe word is matched locally, it never waits for a slot
+                        result = await self._evaluate(user_id, fragments)
+                    else:
+                        async with self._semaphore:
+                            result = await self._evaluate(user_id, fragments)
+                    # Confirmation and alert don't hold an evaluation slot
+                    if result is not None:
+                        await self._on_threat(user_id, result)
+                    self.completed += 1
+                    EVALUATIONS.inc(result="completed")
+                except Exception as e:
+                    self.failed += 1
+                    EVALUATIONS.inc(result="failed")
+                    ERRORS.inc(stage="evaluation")
+                    print(f"[{fragments[-1].request_id}] Error evaluating fragments: {e}")
+                fragments = self._pending.pop(user_id, [])
+        finally:
+            self._running.pop(user_id, None)
+            self._started.pop(user_id, None)
+            self._start_waiting()
+
+    def cancel(self, user_id: str) -> bool:
+        self._waiting.pop(user_id, None)
+        task = self._running.get(user_id)
+        if task is None:
+            return False
+        task.cancel()
+        self._pending.pop(user_id, None)
+        return True
+
+    def cancel_stuck(self, max_age: float) -> int:
+        """Cancel evaluations running for longer than max_age seconds, returns how many."""
+        now = time.monotonic()
+        stuck = [user_id for user_id, started in self._started.items() if now - started > max_age]
+        for user_id in stuck:
+            print(f"Cancelling evaluation running for {now - self._started[user_id]} seconds")
+            self.cancel(user_id)
+        return len(stuck)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._running),
+                "queued_fragments": sum(len(fragments) for fragments in self._pending.values()),
+                "waiting": len(self._waiting),
+                "submitted": self.submitted,
+                "merged": self.merged,
+                "skipped": self.skipped,
+                "queued": self.queued,
+                "failed": self.failed,
+                "completed": self.completed}
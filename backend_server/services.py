@@ -0,0 +1,97 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from executor import executor
+from metrics import registry
+
+# Build every registered backend in the background right after startup,
+# set to False to build each one only when it is first used
+WARM_UP_SERVICES = os.environ.get("WARM_UP_SERVICES", "True") == "True"
+
+SERVICE_INIT_SECONDS = registry.histogram("hearmesafe_service_init_seconds",
+                                          "Time to import and construct each backend service", ["service"])
+
+
+class LazyService:
+    """Stands in for a registered service and builds it on first attribute access."""
+
+    def __init__(self, services: "ServiceRegistry", name: str):
+        self._services = services
+        self._name = name
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._services.get(self._name), attr)
+
+    def __call__(self, *args, **kwargs) -> Any:
+        return self._services.get(self._name)(*args, **kwargs)
+
+
+class ServiceRegistry:
+    """
+    Heavy SDK clients, imported and constructed on first use or during warm-up,
+    so importing the app stays fast and doesn't need every credential to be set.
+    """
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        # service: seconds spent importing and constructing it
+        self.timings: Dict[str, float] = {}
+
+    def register(self, name: str, factory: Callable[[], Any]):
+        self._factories[name] = factory
+        self._locks.setdefault(name, threading.Lock())
+
+    def lazy(self, name: str) -> LazyService:
+        return LazyService(self, name)
+
+    def get(self, name: str) -> Any:
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        # A request arriving during warm-up waits for the same construction
+        with self._locks[name]:
+            instance = self._instances.get(name)
+            if instance is None:
+                started = time.perf_counter()
+                instance = self._factories[name]()
+                elapsed = time.perf_counter() - started
+                self.timings[name] = elapsed
+                SERVICE_INIT_SECONDS.observe(elapsed, service=name)
+                print(f"Service {name} ready in {elapsed:.3f} seconds")
+                self._instances[name] = instance
+            return instance
+
+    def set(self, name: str, instance: Any):
+        """Replace a service, e.g. with a local stand-in in tests."""
+        self._locks.setdefault(name, threading.Lock())
+        self._instances[name] = instance
+
+    def is_ready(self, name: str) -> bool:
+        return name in self._instances
+
+    async def warm_up(self, names: Optional[Iterable[str]] = None) -> Dict[str, float]:
+        """
+        Build the services in worker threads, in parallel and without blocking the event loop.
+        A service that fails is reported and retried on first use.
+
+        Returns:
+            Dict[str, float]: Seconds spent on each service built here
+        """
+        loop = asyncio.get_running_loop()
+        names = [name for name in (names or self._factories) if not self.is_ready(name)]
+        started = time.perf_counter()
+        results = await asyncio.gather(*(loop.run_in_executor(executor, self.get, name) for name in names),
+                                       return_exceptions=True)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                print(f"Error warming up {name}: {result}")
+        print(f"Warm-up finished in {time.perf_counter() - started:.3f} seconds")
+        return {name: self.timings[name] for name in names if name in self.timings}
+
+
+services = ServiceRegistry()
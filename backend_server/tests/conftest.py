@@ -0,0 +1,17 @@
+import os
+import sys
+
+# The backend modules are imported flat, the way main.py imports them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# utils signs tokens with this key, read when it is imported
+os.environ.setdefault("JWT_SECRET_KEY", "test-secret-for-signing-access-tokens")
+
+try:
+    import fakeredis
+    import redis
+except ImportError:
+    pass
+else:
+    # utils and main create their Redis client on import, run them against an in-memory server
+    redis.StrictRedis = lambda *args, **kwargs: fakeredis.FakeStrictRedis()
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+import alerts
+from alerts import AlertOutbox, FakeTransport, OUTBOX_KEY
+
+
+@pytest.fixture
+def redis_client():
+    # The outbox relies on Lua scripts, which fakeredis runs through lupa
+    pytest.importorskip("lupa")
+    client = fakeredis.FakeStrictRedis()
+    client.flushall()
+    return client
+
+
+def enqueue(outbox, alert_id="a1"):
+    return outbox.enqueue(alert_id, "u1", to="friend@example.com", bcc=None, body="Come get me")
+
+
+def test_enqueue_is_idempotent(redis_client):
+    outbox = AlertOutbox(redis_client, FakeTransport())
+    assert enqueue(outbox)
+    assert not enqueue(outbox)
+    assert outbox.due() == ["a1"]
+
+
+def test_deliver_sends_once_and_removes_the_alert(redis_client):
+    transport = FakeTransport()
+    outbox = AlertOutbox(redis_client, transport)
+    enqueue(outbox)
+    assert outbox.deliver("a1") is True
+    assert outbox.deliver("a1") is None
+    assert [alert["body"] for alert in transport.sent] == ["Come get me"]
+    assert redis_client.hget("alert:a1", "status") == b"sent"
+    assert outbox.stats() == {"pending": 0, "delivered": 1, "retried": 0, "failed": 0}
+
+
+def test_leased_alert_is_not_claimed_by_another_worker(redis_client):
+    outbox = AlertOutbox(redis_client, FakeTransport())
+    other = AlertOutbox(redis_client, FakeTransport())
+    enqueue(outbox)
+    # Claiming only pushes the alert's score back by the lease, as a worker mid-send would
+    assert outbox._claim(keys=[OUTBOX_KEY], args=["a1", time.time(), time.time() + 60])
+    assert other.deliver("a1") is None
+    assert outbox.due() == []
+
+
+def test_failed_sends_are_retried_then_given_up(redis_client, monkeypatch):
+    monkeypatch.setattr(alerts, "ALERT_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(alerts, "ALERT_RETRY_BASE_SECONDS", 0)
+    outbox = AlertOutbox(redis_client, FakeTransport(failures=5))
+    enqueue(outbox)
+    assert outbox.deliver("a1") is False
+    assert redis_client.zscore(OUTBOX_KEY, "a1") is not None
+    assert outbox.deliver("a1") is False
+    assert redis_client.zscore(OUTBOX_KEY, "a1") is None
+    assert redis_client.hget("alert:a1", "status") == b"failed"
+    assert (outbox.retried, outbox.failed) == (1, 1)
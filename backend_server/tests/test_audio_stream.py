@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from audio_stream import FragmentAssembler, FrameError, encode_frame, parse_frame
+
+
+def test_frame_round_trip():
+    header = {"seq": 3, "final": True, "gps": "lat: 1; long: 2"}
+    parsed, chunk = parse_frame(encode_frame(header, b"audio"))
+    assert parsed == header
+    assert bytes(chunk) == b"audio"
+
+
+@pytest.mark.parametrize("data", [b"", b"\x00", b"\x00\x05{bad}", b"\x00\x02[]", b'\x00\x0b{"seq": "1"}'])
+def test_invalid_frames(data):
+    with pytest.raises(FrameError):
+        parse_frame(data)
+
+
+def add(assembler, header, chunk=b""):
+    return assembler.add(header, memoryview(chunk))
+
+
+def test_assembles_chunks_until_final():
+    assembler = FragmentAssembler(max_bytes=100, max_inflight=1, max_open=4)
+    fragment = add(assembler, {"seq": 1, "gps": "lat: 1; long: 2"}, b"ab")
+    assert not fragment.complete and fragment.chunks == 1
+    assert add(assembler, {"seq": 1, "labels": [["Speech", 0.9]]}, b"cd") is fragment
+    add(assembler, {"seq": 1, "final": True}, b"ef")
+    assert fragment.complete
+    assert bytes(fragment.audio) == b"abcdef"
+    assert fragment.gps == "lat: 1; long: 2"
+    assert fragment.labels == [["Speech", 0.9]]
+    assert assembler.stats() == {"open": 0, "in_flight": 0, "fragments": 1, "dropped": 0}
+
+
+def test_rejects_oversized_fragment():
+    assembler = FragmentAssembler(max_bytes=4)
+    add(assembler, {"seq": 1}, b"abc")
+    with pytest.raises(FrameError):
+        add(assembler, {"seq": 1}, b"de")
+    assert assembler.stats()["dropped"] == 1
+    # A new chunk with the same seq starts over
+    assert add(assembler, {"seq": 1}, b"x").chunks == 1
+
+
+def test_drops_oldest_unfinished_fragment():
+    assembler = FragmentAssembler(max_open=2)
+    first = add(assembler, {"seq": 1}, b"a")
+    add(assembler, {"seq": 2}, b"b")
+    add(assembler, {"seq": 3}, b"c")
+    assert assembler.stats()["open"] == 2
+    assert assembler.stats()["dropped"] == 1
+    assert add(assembler, {"seq": 1}, b"a") is not first
+
+
+def test_rejected_fragment_discards_audio():
+    assembler = FragmentAssembler()
+    fragment = add(assembler, {"seq": 1}, b"ab")
+    fragment.rejected = True
+    add(assembler, {"seq": 1, "final": True}, b"cd")
+    assert fragment.complete
+    assert bytes(fragment.audio) == b"ab"
+
+
+def test_disconnect_keeps_completed_fragments():
+    async def scenario():
+        assembler = FragmentAssembler()
+        add(assembler, {"seq": 1, "final": True}, b"pineapple")
+        add(assembler, {"seq": 2}, b"half")
+        processed = []
+
+        async def process():
+            await asyncio.sleep(0.05)
+            processed.append(1)
+
+        assembler.track(asyncio.create_task(process()))
+        # The socket closed: the endpoint drops what never finished and is then cancelled mid-drain
+        assert assembler.drop_unfinished() == 1
+        endpoint = asyncio.create_task(assembler.drain())
+        await asyncio.sleep(0)
+        endpoint.cancel()
+        await asyncio.sleep(0.1)
+        return processed
+
+    assert asyncio.run(scenario()) == [1]
@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+from confirmation import ConfirmationRegistry
+
+
+def test_resolve_answers_the_waiting_threat():
+    async def scenario():
+        registry = ConfirmationRegistry()
+        confirmation = registry.open("u1", timeout=5)
+        assert "u1" in registry
+        asyncio.get_running_loop().call_soon(registry.resolve, "u1", False)
+        return await confirmation.wait()
+
+    assert asyncio.run(scenario()) is False
+
+
+def test_timeout_returns_none():
+    async def scenario():
+        return await ConfirmationRegistry().open("u1", timeout=0.01).wait()
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_window_runs_from_open_not_from_wait():
+    async def scenario():
+        confirmation = ConfirmationRegistry().open("u1", timeout=0.2)
+        # e.g. the prompt took this long to reach the phone
+        await asyncio.sleep(0.15)
+        started = time.monotonic()
+        assert await confirmation.wait() is None
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 0.15
+
+
+def test_one_confirmation_per_user_and_bounded():
+    async def scenario():
+        registry = ConfirmationRegistry(max_pending=1)
+        first = registry.open("u1")
+        assert registry.open("u1") is first
+        assert registry.open("u2") is None
+        assert not registry.resolve("u2", True)
+        registry.close(first)
+        assert "u1" not in registry and len(registry) == 0
+        assert registry.open("u2") is not None
+
+    asyncio.run(scenario())
+
+
+def test_only_first_answer_counts():
+    async def scenario():
+        registry = ConfirmationRegistry()
+        confirmation = registry.open("u1", timeout=5)
+        registry.resolve("u1", True)
+        registry.resolve("u1", False)
+        return await confirmation.wait()
+
+    assert asyncio.run(scenario()) is True
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from gps_track import GpsTrack, GpsTracks, distance_meters, format_movement, parse_gps, summarize
+
+
+def test_parse_gps():
+    assert parse_gps("lat: 44.4268; long: 26.1025") == (44.4268, 26.1025)
+    assert parse_gps("lat:-33.9;lng:151.2") == (-33.9, 151.2)
+    assert parse_gps(None) is None
+    assert parse_gps("") is None
+    assert parse_gps("somewhere") is None
+    assert parse_gps("lat: 91; long: 0") is None
+    assert parse_gps("lat: 0; long: 181") is None
+
+
+def test_distance_meters():
+    # One degree of latitude is about 111 km
+    assert distance_meters((0, 0), (1, 0)) == pytest.approx(111195, rel=1e-3)
+    assert distance_meters((44.4, 26.1), (44.4, 26.1)) == 0
+
+
+def test_summarize_moving_north():
+    # 0.0001 degrees of latitude (~11 m) every 5 seconds
+    samples = np.array([(i * 5.0, 44.0 + i * 0.0001, 26.0) for i in range(13)])
+    summary = summarize(samples, path_points=4)
+    assert summary.latest == (44.0012, 26.0)
+    assert summary.elapsed == 60
+    assert summary.distance == pytest.approx(133.4, rel=1e-2)
+    assert summary.speed == pytest.approx(summary.distance / 60)
+    assert summary.heading == pytest.approx(0, abs=0.01)
+    assert summary.path[0] == (44.0, 26.0) and summary.path[-1] == summary.latest
+    assert len(summary.path) == 4
+    assert format_movement(summary).startswith("Moving north at about 8 km/h")
+
+
+def test_summarize_jitter_is_not_movement():
+    samples = np.array([(i * 5.0, 44.0 + (i % 2) * 0.00005, 26.0) for i in range(6)])
+    summary = summarize(samples, min_movement=25)
+    assert summary.heading is None
+    assert summary.speed == 0
+    assert format_movement(summary).startswith("Not moving much")
+
+
+def test_summarize_single_sample():
+    summary = summarize(np.array([(10.0, 1.0, 2.0)]))
+    assert summary.latest == (1.0, 2.0)
+    assert summary.distance == 0 and summary.heading is None
+
+
+def test_track_ring_buffer_keeps_latest_in_order():
+    track = GpsTrack(size=3)
+    for i in range(5):
+        assert track.add((float(i), 0.0), received=100.0 + i)
+    recent = track.recent(max_age=1000)
+    assert list(recent[:, 0]) == [102.0, 103.0, 104.0]
+    assert list(recent[:, 1]) == [2.0, 3.0, 4.0]
+
+
+def test_track_ignores_out_of_order_samples():
+    track = GpsTrack(size=3)
+    track.add((1.0, 1.0), received=10.0)
+    assert not track.add((2.0, 2.0), received=9.0)
+    assert track.count == 1
+
+
+def test_tracks_summary_and_prune(monkeypatch):
+    import gps_track
+    monkeypatch.setattr(gps_track.time, "time", lambda: 1000.0)
+    tracks = GpsTracks(max_tracks=2, max_age=60)
+    assert tracks.add("u1", "no fix", 990.0) is None
+    tracks.add("u1", "lat: 1; long: 2", 990.0)
+    tracks.add("old", "lat: 1; long: 2", 100.0)
+    assert tracks.summary("u1").latest == (1.0, 2.0)
+    assert tracks.summary("u1", since=990.0) is None
+    assert tracks.summary("old") is None
+    assert tracks.prune() == 1
+    assert len(tracks) == 1
@@ -0,0 +1,46 @@
+from labels import parse_labels, top_labels, has_speech, format_labels, merge_labels
+
+
+def test_parse_json_objects_sorted_by_score():
+    raw = '[{"category": "Shout", "score": 0.4}, {"category": "Speech", "score": 0.9}]'
+    assert parse_labels(raw) == (("Speech", 0.9), ("Shout", 0.4))
+
+
+def test_parse_pairs_already_decoded():
+    assert parse_labels([["Music", "0.3"], ["Speech", 0.7]]) == (("Speech", 0.7), ("Music", 0.3))
+
+
+def test_parse_legacy_category_dump():
+    raw = ('[<Category "Speech" (displayName= score=0.91 index=0)>, '
+           '<Category "Crying, sobbing" (displayName= score=0.25 index=19)>]')
+    assert parse_labels(raw) == (("Speech", 0.91), ("Crying, sobbing", 0.25))
+
+
+def test_parse_missing_or_invalid_labels():
+    assert parse_labels(None) == ()
+    assert parse_labels("") == ()
+    assert parse_labels('[{"category": "Speech"}]') == ()
+    assert parse_labels("not labels at all") == ()
+
+
+def test_top_labels_applies_threshold_and_k():
+    labels = (("Speech", 0.9), ("Shout", 0.5), ("Music", 0.3), ("Dog", 0.25), ("Wind", 0.1))
+    assert top_labels(labels, k=3, threshold=0.2) == (("Speech", 0.9), ("Shout", 0.5), ("Music", 0.3))
+    assert top_labels(labels, k=5, threshold=0.4) == (("Speech", 0.9), ("Shout", 0.5))
+
+
+def test_has_speech():
+    assert has_speech(()) is None
+    assert has_speech((("Speech", 0.9),), threshold=0.2) is True
+    assert has_speech((("Speech", 0.1), ("Music", 0.9)), threshold=0.2) is False
+    assert has_speech((("Crying, sobbing", 0.5),), threshold=0.2) is True
+
+
+def test_format_labels():
+    assert format_labels((("Speech", 0.912), ("Shout", 0.4))) == "Speech 0.91, Shout 0.40"
+    assert format_labels(None) == ""
+
+
+def test_merge_keeps_each_class_at_its_highest_score():
+    merged = merge_labels([(("Screaming", 0.8), ("Speech", 0.3)), (), (("Speech", 0.9),)])
+    assert merged == (("Speech", 0.9), ("Screaming", 0.8))
@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+from alerts import FakeTransport
+from scheduler import Fragment
+from services import services
+
+
+class BrokenModel:
+    def generate_content(self, *args, **kwargs):
+        raise RuntimeError("Gemini is down")
+
+
+@pytest.fixture
+def main():
+    services.set("gemini_model", BrokenModel())
+    services.set("alert_transport", FakeTransport())
+    import main
+    from utils import save_user, update_user_settings
+    save_user("bob", "pw", "u1")
+    update_user_settings("u1", {"friend_email": "friend@example.com", "safe_word": "pineapple"})
+    return main
+
+
+def test_safe_word_alert_is_sent_without_gemini(main):
+    async def scenario():
+        await main.alert_outbox.start()
+        try:
+            result = await main.process_message("u1", [Fragment("say Pineapple!", None, (), "r1", time.time())])
+            assert result["threat_response"]["alert_message"] == main.FALLBACK_ALERT_MESSAGE
+            # The user confirms rather than waiting out the window
+            asyncio.get_running_loop().call_later(0.05, main.confirmations.resolve, "u1", True)
+            await main.handle_threat("u1", result)
+            main.stop_location_updates("u1")
+            await asyncio.sleep(0.2)
+        finally:
+            await main.alert_outbox.stop()
+
+    asyncio.run(scenario())
+    sent = services.get("alert_transport").sent
+    assert [alert["to"] for alert in sent] == ["friend@example.com"]
+    assert sent[0]["body"].startswith(main.FALLBACK_ALERT_MESSAGE)
@@ -0,0 +1,82 @@
+import pytest
+
+import rate_limit
+from rate_limit import Budget, LocalRateLimiter, RateLimiter, parse_budget
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    return clock
+
+
+def test_parse_budget():
+    assert parse_budget("0.5/10") == Budget(0.5, 10.0)
+
+
+def test_burst_then_retry_after(clock):
+    limiter = LocalRateLimiter()
+    budget = Budget(rate=1, burst=3)
+    assert [limiter.acquire("k", budget) for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire("k", budget) == pytest.approx(1.0)
+    clock.now += 1
+    assert limiter.acquire("k", budget) == 0
+    # Keys have separate buckets
+    assert limiter.acquire("other", budget) == 0
+
+
+def test_refill_is_capped_at_burst(clock):
+    limiter = LocalRateLimiter()
+    budget = Budget(rate=1, burst=2)
+    limiter.acquire("k", budget)
+    clock.now += 100
+    assert [limiter.acquire("k", budget) for _ in range(3)][-1] > 0
+
+
+def test_least_recently_used_keys_are_dropped(clock):
+    limiter = LocalRateLimiter(max_keys=2)
+    budget = Budget(rate=1, burst=1)
+    for key in ("a", "b", "c"):
+        limiter.acquire(key, budget)
+    assert len(limiter) == 2
+    # "a" was dropped, so it starts with a full bucket again
+    assert limiter.acquire("a", budget) == 0
+
+
+def test_prune_idle_buckets(clock):
+    limiter = LocalRateLimiter()
+    budget = Budget(rate=1, burst=1)
+    limiter.acquire("old", budget)
+    clock.now += 60
+    limiter.acquire("new", budget)
+    assert limiter.prune(max_idle=30) == 1
+    assert len(limiter) == 1
+
+
+def test_rate_limiter_checks_scopes(clock, monkeypatch):
+    monkeypatch.setitem(rate_limit.budgets, "upload", Budget(rate=1, burst=1))
+    limiter = RateLimiter(LocalRateLimiter(), enabled=True)
+    assert limiter.check("upload", "u1") == 0
+    assert limiter.check("upload", "u1") > 0
+    # Unknown scopes and missing keys are never limited
+    assert limiter.check("unknown", "u1") == 0
+    assert limiter.check("upload", None) == 0
+    assert limiter.check_all([("upload", "u2"), ("upload", "u1")]) > 0
+    assert RateLimiter(LocalRateLimiter(), enabled=False).check("upload", "u1") == 0
+
+
+def test_rate_limiter_fails_open():
+    class Broken:
+        def acquire(self, key, budget, cost=1):
+            raise ConnectionError("Redis is down")
+
+    assert RateLimiter(Broken(), enabled=True).check("upload", "u1") == 0
@@ -0,0 +1,135 @@
+import asyncio
+
+from scheduler import EvaluationScheduler, Fragment
+
+
+def fragment(message: str) -> Fragment:
+    return Fragment(message, None, (), "request", 0.0)
+
+
+def run(scenario):
+    """Evaluations block until released, so the test decides when each one finishes."""
+    async def main():
+        evaluated = []
+        release = asyncio.Event()
+
+        async def evaluate(user_id, fragments):
+            evaluated.append((user_id, [f.message for f in fragments]))
+            await release.wait()
+            return {"threat": True} if any(f.message == "help" for f in fragments) else None
+
+        threats = []
+
+        async def on_threat(user_id, result):
+            threats.append(user_id)
+
+        await scenario(evaluate, on_threat, evaluated, threats, release)
+
+    asyncio.run(main())
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_fragments_arriving_during_an_evaluation_are_merged():
+    async def scenario(evaluate, on_threat, evaluated, threats, release):
+        scheduler = EvaluationScheduler(evaluate, on_threat)
+        assert scheduler.submit("u1", fragment("one")) == "scheduled"
+        await settle()
+        assert scheduler.submit("u1", fragment("two")) == "merged"
+        assert scheduler.submit("u1", fragment("help")) == "merged"
+        release.set()
+        await settle()
+        assert evaluated == [("u1", ["one"]), ("u1", ["two", "help"])]
+        assert threats == ["u1"]
+        assert scheduler.stats()["in_flight"] == 0
+
+    run(scenario)
+
+
+def test_busy_users_are_skipped():
+    async def scenario(evaluate, on_threat, evaluated, threats, release):
+        scheduler = EvaluationScheduler(evaluate, on_threat, is_busy=lambda user_id: user_id == "u1")
+        assert scheduler.submit("u1", fragment("one")) == "skipped"
+        await settle()
+        assert evaluated == []
+
+    run(scenario)
+
+
+def test_users_beyond_the_cap_wait_in_line():
+    async def scenario(evaluate, on_threat, evaluated, threats, release):
+        scheduler = EvaluationScheduler(evaluate, on_threat, max_running=1)
+        assert scheduler.submit("u1", fragment("one")) == "scheduled"
+        assert scheduler.submit("u2", fragment("a")) == "queued"
+        assert scheduler.submit("u2", fragment("b")) == "merged"
+        await settle()
+        assert evaluated == [("u1", ["one"])]
+        assert scheduler.stats()["waiting"] == 1
+        release.set()
+        await settle()
+        assert evaluated == [("u1", ["one"]), ("u2", ["a", "b"])]
+        assert scheduler.stats()["waiting"] == 0
+
+    run(scenario)
+
+
+def test_only_the_latest_fragments_are_kept_per_user():
+    async def scenario(evaluate, on_threat, evaluated, threats, release):
+        scheduler = EvaluationScheduler(evaluate, on_threat, max_running=1, max_pending=2)
+        scheduler.submit("u1", fragment("one"))
+        for message in ("a", "b", "c"):
+            scheduler.submit("u1", fragment(message))
+            scheduler.submit("u2", fragment(message))
+        assert scheduler.stats()["queued_fragments"] == 2
+        release.set()
+        await settle()
+        assert evaluated == [("u1", ["one"]), ("u1", ["b", "c"]), ("u2", ["b", "c"])]
+
+    run(scenario)
+
+
+def test_urgent_fragments_skip_the_line():
+    async def scenario(evaluate, on_threat, evaluated, threats, release):
+        scheduler = EvaluationScheduler(evaluate, on_threat, max_running=1,
+                                        is_urgent=lambda user_id, f: f.message == "pineapple")
+        scheduler.submit("u1", fragment("one"))
+        assert scheduler.submit("u2", fragment("before")) == "queued"
+        assert scheduler.submit("u2", fragment("pineapple")) == "scheduled"
+        await settle()
+        assert ("u2", ["before", "pineapple"]) in evaluated
+        release.set()
+
+    run(scenario)
+
+
+def test_urgent_fragments_dont_wait_for_a_concurrency_slot():
+    async def scenario(evaluate, on_threat, evaluated, threats, release):
+        scheduler = EvaluationScheduler(evaluate, on_threat, max_concurrent=1,
+                                        is_urgent=lambda user_id, f: f.message == "pineapple")
+        scheduler.submit("u1", fragment("one"))
+        await settle()
+        # u1 holds the only slot until released
+        assert scheduler.submit("u2", fragment("pineapple")) == "scheduled"
+        await settle()
+        assert ("u2", ["pineapple"]) in evaluated
+        release.set()
+
+    run(scenario)
+
+
+def test_failed_evaluation_is_counted_and_frees_the_user():
+    async def scenario(evaluate, on_threat, evaluated, threats, release):
+        async def broken(user_id, fragments):
+            raise RuntimeError("Gemini is down")
+
+        scheduler = EvaluationScheduler(broken, on_threat)
+        scheduler.submit("u1", fragment("one"))
+        await settle()
+        assert scheduler.stats()["failed"] == 1
+        assert scheduler.submit("u1", fragment("two")) == "scheduled"
+        await settle()
+
+    run(scenario)
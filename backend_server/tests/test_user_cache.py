@@ -0,0 +1,36 @@
+from user_cache import UserCache
+
+
+def test_hit_after_load():
+    cache = UserCache()
+    loads = []
+
+    def loader(user_id):
+        loads.append(user_id)
+        return {"username": "bob", "safe_word": "pineapple"}
+
+    assert cache.get("u1", loader)["safe_word"] == "pineapple"
+    assert cache.get("u1", loader)["safe_word"] == "pineapple"
+    assert loads == ["u1"]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_load_older_than_a_write_is_not_stored():
+    cache = UserCache()
+
+    def stale_loader(user_id):
+        # The new safe word is written while the old profile is on its way back
+        cache.update(user_id, {"safe_word": "mango"})
+        return {"username": "bob", "safe_word": "pineapple"}
+
+    cache.get("u1", stale_loader)
+    assert len(cache) == 0
+    assert cache.get("u1", lambda user_id: {"username": "bob", "safe_word": "mango"})["safe_word"] == "mango"
+    assert len(cache) == 1
+
+
+def test_invalidate_by_username():
+    cache = UserCache()
+    cache.get("u1", lambda user_id: {"username": "bob"})
+    cache.invalidate_username("bob")
+    assert len(cache) == 0 and cache.invalidations == 1
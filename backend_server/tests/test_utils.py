@@ -0,0 +1,62 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import utils
+from utils import AuthManager, compile_safe_word, contains_safe_word, parse_model_json
+
+
+@pytest.mark.parametrize("message", ["Pineapple Express", "say it: PINEAPPLE express!", "pineapple, express"])
+def test_safe_word_ignores_case_and_punctuation(message, monkeypatch):
+    monkeypatch.setattr(utils, "get_user_settings", lambda user_id: {"safe_word": "Pineapple express"})
+    assert contains_safe_word(message, "u1")
+
+
+@pytest.mark.parametrize("message", ["pineapple", "express pineapple", "pineapples express", ""])
+def test_safe_word_needs_every_word_in_order(message, monkeypatch):
+    monkeypatch.setattr(utils, "get_user_settings", lambda user_id: {"safe_word": "Pineapple express"})
+    assert not contains_safe_word(message, "u1")
+
+
+def test_without_safe_word_nothing_matches(monkeypatch):
+    assert compile_safe_word(None) is None
+    assert compile_safe_word(" ?! ") is None
+    monkeypatch.setattr(utils, "get_user_settings", lambda user_id: {})
+    assert not contains_safe_word("anything", "u1")
+
+
+@pytest.mark.parametrize("text", ['{"threat_level": 1}', '```json\n{"threat_level": 1}\n```', ' ```{"threat_level": 1}``` '])
+def test_parse_model_json_tolerates_fences(text):
+    assert parse_model_json(text) == {"threat_level": 1}
+
+
+def test_parse_model_json_rejects_prose():
+    with pytest.raises(ValueError):
+        parse_model_json("There is no threat.")
+
+
+def test_verified_token_expires_from_the_cache():
+    async def scenario():
+        auth = AuthManager()
+        token = auth.generate_tokens("u1")["access_token"]
+        assert await auth.authenticate(token) == "u1"
+        assert token in auth.verified_tokens
+        # The cached entry is trusted until its exp, then dropped without another signature check
+        auth.verified_tokens[token] = ("u1", 0)
+        assert await auth.authenticate(token) is None
+        assert token not in auth.verified_tokens
+
+    asyncio.run(scenario())
+
+
+def test_prune_expired_tokens():
+    auth = AuthManager()
+    now = datetime.now(timezone.utc)
+    auth.refresh_tokens = {"u1": {"token": "a", "expires": now + timedelta(days=1)},
+                           "u2": {"token": "b", "expires": now - timedelta(days=1)}}
+    auth.verified_tokens["fresh"] = ("u1", now.timestamp() + 60)
+    auth.verified_tokens["stale"] = ("u2", 0)
+    assert auth.prune_expired() == 2
+    assert list(auth.refresh_tokens) == ["u1"]
+    assert list(auth.verified_tokens) == ["fresh"]
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+
+from labels import Labels, merge_labels
+
+# Number of recent fragments (5 seconds each) Gemini sees together
+TRANSCRIPT_WINDOW_SIZE = int(os.environ.get("TRANSCRIPT_WINDOW_SIZE", 4))
+# Fragments older than this no longer count as context
+TRANSCRIPT_WINDOW_SECONDS = float(os.environ.get("TRANSCRIPT_WINDOW_SECONDS", 30))
+MAX_TRANSCRIPT_WINDOWS = int(os.environ.get("MAX_TRANSCRIPT_WINDOWS", 10000))
+
+NO_SPEECH_TEXT = "No speech detected"
+
+
+class WindowEntry:
+    """What the window keeps of a fragment."""
+
+    __slots__ = ("received", "text", "labels")
+
+    def __init__(self, text: Optional[str], labels: Optional[Labels]):
+        self.received = time.monotonic()
+        self.text = text
+        self.labels = labels
+
+
+class TranscriptWindow:
+    """Ring buffer of a user's most recent fragments."""
+
+    def __init__(self, size: int = TRANSCRIPT_WINDOW_SIZE, max_age: float = TRANSCRIPT_WINDOW_SECONDS):
+        self.max_age = max_age
+        self.fragments: deque = deque(maxlen=size)
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.max_age
+        while self.fragments and self.fragments[0].received < cutoff:
+            self.fragments.popleft()
+
+    def add(self, text: Optional[str], labels: Optional[Labels]) -> bool:
+        """
+        Record a fragment.
+
+        Returns:
+            bool: True if the fragment added new text, i.e. the window is worth evaluating again
+        """
+        self._expire()
+        has_text = bool(text and text.strip()) and text != NO_SPEECH_TEXT
+        self.fragments.append(WindowEntry(text if has_text else None, labels))
+        return has_text
+
+    def text(self) -> str:
+        self._expire()
+        return " ".join(fragment.text for fragment in self.fragments if fragment.text)
+
+    def labels(self) -> Labels:
+        """The sounds heard over the window, so a scream before the words still counts."""
+        self._expire()
+        return merge_labels(fragment.labels for fragment in self.fragments)
+
+    def is_empty(self) -> bool:
+        self._expire()
+        return not self.fragments
+
+    def clear(self):
+        self.fragments.clear()
+
+
+class TranscriptWindows:
+    """Bounded set of per-user windows, least recently used users are dropped first."""
+
+    def __init__(self, max_windows: int = MAX_TRANSCRIPT_WINDOWS):
+        self.max_windows = max_windows
+        self._windows: "OrderedDict[str, TranscriptWindow]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def get(self, user_id: str) -> TranscriptWindow:
+        with self._lock:
+            window = self._windows.get(user_id)
+            if window is None:
+                window = TranscriptWindow()
+                self._windows[user_id] = window
+                if len(self._windows) > self.max_windows:
+                    self._windows.popitem(last=False)
+            else:
+                self._windows.move_to_end(user_id)
+            return window
+
+    def prune(self) -> int:
+        """Drop windows whose fragments all aged out, returns how many."""
+        with self._lock:
+            idle = [user_id for user_id, window in self._windows.items() if window.is_empty()]
+            for user_id in idle:
+                del self._windows[user_id]
+        return len(idle)
+
+    def reset(self, user_id: str):
+        """Forget the context once a threat was handled, so it doesn't trigger again."""
+        with self._lock:
+            window = self._windows.get(user_id)
+        if window is not None:
+            window.clear()
@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from metrics import USER_CACHE_LOOKUPS
+
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 30))
+# Requires notify-keyspace-events to include "Kh" on the Redis instance
+USER_CACHE_KEYSPACE_INVALIDATION = os.environ.get("USER_CACHE_KEYSPACE_INVALIDATION", "False") == "True"
+
+
+class UserCache:
+    """
+    In-process LRU cache of user profiles (settings, username, threat status) with a TTL.
+    Writes made through this process update the cached entry, writes made by other
+    workers are picked up after the TTL or through keyspace notifications.
+    """
+
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._by_username: Dict[str, str] = {}
+        # Bumped by every write, a load that started before a write to its user is not stored
+        self._generation = 0
+        # user_id: loads in flight, and the generation of the latest write made during them
+        self._loading: Dict[str, int] = {}
+        self._written: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._pubsub_thread = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: str, loader: Callable[[str], Optional[dict]]) -> Optional[dict]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                USER_CACHE_LOOKUPS.inc(result="hit")
+                return dict(entry[1])
+            self.misses += 1
+            USER_CACHE_LOOKUPS.inc(result="miss")
+            started = self._generation
+            self._loading[user_id] = self._loading.get(user_id, 0) + 1
+        try:
+            profile = loader(user_id)
+            if profile is not None:
+                self._store(user_id, profile, started)
+        finally:
+            with self._lock:
+                self._loading[user_id] -= 1
+                if not self._loading[user_id]:
+                    del self._loading[user_id]
+                    self._written.pop(user_id, None)
+        return dict(profile) if profile is not None else None
+
+    def _store(self, user_id: str, profile: dict, started: int):
+        with self._lock:
+            if self._written.get(user_id, 0) > started:
+                # Written while this was loading, e.g. a new safe_word, the load may predate it
+                return
+            self._entries[user_id] = (time.monotonic() + self.ttl, profile)
+            self._entries.move_to_end(user_id)
+            if profile.get("username"):
+                self._by_username[profile["username"]] = user_id
+            while len(self._entries) > self.maxsize:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._by_username.pop(evicted.get("username"), None)
+
+    def _written_to(self, user_id: str):
+        """Call with the lock held whenever the user's profile changes."""
+        self._generation += 1
+        if user_id in self._loading:
+            self._written[user_id] = self._generation
+
+    def update(self, user_id: str, fields: dict):
+        """Write-through: apply fields already written to Redis to the cached entry."""
+        with self._lock:
+            self._written_to(user_id)
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry[1].update(fields)
+
+    def prune(self) -> int:
+        """Drop expired entries, returns how many."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [user_id for user_id, (expires, _) in self._entries.items() if expires <= now]
+            for user_id in expired:
+                _, profile = self._entries.pop(user_id)
+                self._by_username.pop(profile.get("username"), None)
+        return len(expired)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._written_to(user_id)
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self._by_username.pop(entry[1].get("username"), None)
+                self.invalidations += 1
+
+    def invalidate_username(self, username: str):
+        user_id = self._by_username.get(username)
+        if user_id is not None:
+            self.invalidate(user_id)
+
+    def listen_for_invalidations(self, redis_client, db: int = 0):
+        """Drop entries when their user:<username> hash changes, from any worker."""
+        prefix = f"__keyspace@{db}__:user:"
+
+        def handler(message):
+            channel = message["channel"].decode("utf-8")
+            self.invalidate_username(channel[len(prefix):])
+
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(**{f"{prefix}*": handler})
+        self._pubsub_thread = pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+
+    def stop(self):
+        if self._pubsub_thread is not None:
+            self._pubsub_thread.stop()
+            self._pubsub_thread = None
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations}
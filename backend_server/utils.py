@@ -5,39 +5,78 @@ import re
 import secrets
 import redis
 import tempfile
-import numpy as np
-from typing import Optional, Annotated, Dict, Any
-from passlib.context import CryptContext
+import io
+import shutil
+from typing import Optional, Annotated, Dict, Any, Union
 from fastapi import UploadFile
-from google.cloud import speech
-import google.generativeai as genai
 import asyncio
 from pydantic import BaseModel, Field
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email
-from python_http_client.exceptions import HTTPError
-from pedalboard import Pedalboard, NoiseGate, Compressor, LowShelfFilter, Gain, HighShelfFilter, Limiter
-from pedalboard.io import AudioFile
+from recognizer import get_recognizer, NO_SPEECH
+from audio_processing import PREPROCESS_AUDIO, condition_audio
+from user_cache import UserCache, USER_CACHE_SIZE
+from alerts import AlertOutbox, SendGridTransport, ALERT_SUBJECT
+from event_log import EventLog
+from services import services
+from labels import Labels, parse_labels, top_labels, format_labels
+from gps_track import Point, TrackSummary, parse_gps, format_movement
+from functools import lru_cache
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
 
 SECRET_KEY = os.environ.get('JWT_SECRET_KEY')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 REFRESH_TOKEN_EXPIRE_DAYS = 7
+# Number of already verified access tokens kept by AuthManager
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 10000))
+# Uploads up to this size are transcribed straight from memory, larger ones spill to disk
+UPLOAD_SPOOL_MAX_BYTES = int(os.environ.get("UPLOAD_SPOOL_MAX_BYTES", 1024 * 1024))
+# Spilled uploads older than this were left behind by a crash and get swept
+UPLOAD_FILE_MAX_AGE = float(os.environ.get("UPLOAD_FILE_MAX_AGE", 600))
 
 sendgrid_api_key = os.environ.get("SENDGRID_API_KEY")
-sg = SendGridAPIClient(sendgrid_api_key)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def create_password_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+def create_gemini_model():
+    import google.generativeai as genai
+    api_key = os.environ.get('GEMINI_API_KEY')
+    if not api_key:
+        raise RuntimeError("GEMINI_API_KEY is not set")
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel('gemini-1.5-flash')
+
+# SDK clients are built on first use or during warm-up, not when this module is imported
+services.register("pwd_context", create_password_context)
+services.register("gemini_model", create_gemini_model)
+services.register("alert_transport",
+                  lambda: SendGridTransport(sendgrid_api_key, os.environ.get("SENDGRID_SENDER")))
+
+pwd_context = services.lazy("pwd_context")
 redis_host = os.environ.get("REDISHOST", "localhost")
 redis_port = int(os.environ.get("REDISPORT", 6379))
 redis_client = redis.StrictRedis(host=redis_host, port=redis_port)
+# user_id: profile, loaded with one HGETALL and kept up to date by our own writes
+user_cache = UserCache()
+# Per-user history of fragments, verdicts and alerts for later review
+event_log = EventLog(redis_client)
+# Alerts are written to Redis first and delivered by a background worker
+alert_outbox = AlertOutbox(redis_client, services.lazy("alert_transport"), event_log=event_log)
 
 class AuthManager:
-    def __init__(self):
+    def __init__(self, token_cache_size: int = TOKEN_CACHE_SIZE):
         self.refresh_tokens = {}  # user_id: refresh_token mapping
+        # token: (user_id, exp) for tokens whose signature was already verified
+        self.verified_tokens: "OrderedDict[str, tuple]" = OrderedDict()
+        self.token_cache_size = token_cache_size
 
     def generate_tokens(self, user_id: str) -> dict:
         """Generate both access and refresh tokens"""
@@ -58,15 +97,28 @@ class AuthManager:
 
     async def authenticate(self, token: str) -> Optional[str]:
         """Verify the JWT token and return user_id if valid"""
+        cached = self.verified_tokens.get(token)
+        if cached is not None:
+            user_id, expires = cached
+            if expires > datetime.now(timezone.utc).timestamp():
+                self.verified_tokens.move_to_end(token)
+                return user_id
+            del self.verified_tokens[token]
+            return None
         try:
             payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
             if payload.get('type') != 'access':
                 return None
-            return payload['user_id']
 
         except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
             return None
 
+        # Uploads repeat the same token every few seconds, skip the signature check next time
+        self.verified_tokens[token] = (payload['user_id'], payload['exp'])
+        if len(self.verified_tokens) > self.token_cache_size:
+            self.verified_tokens.popitem(last=False)
+        return payload['user_id']
+
     async def refresh_access_token(self, refresh_token: str, user_id: str) -> Optional[dict]:
         """Validate refresh token and generate new access token"""
         stored_refresh = self.refresh_tokens.get(user_id)
@@ -78,6 +130,19 @@ class AuthManager:
             return None
 
         return self.generate_tokens(user_id)
+
+    def prune_expired(self) -> int:
+        """Forget expired refresh tokens and verified access tokens, returns how many."""
+        now = datetime.now(timezone.utc)
+        expired_refresh = [user_id for user_id, stored in self.refresh_tokens.items()
+                           if now > stored["expires"]]
+        for user_id in expired_refresh:
+            del self.refresh_tokens[user_id]
+        timestamp = now.timestamp()
+        expired_access = [token for token, (_, expires) in self.verified_tokens.items() if expires <= timestamp]
+        for token in expired_access:
+            del self.verified_tokens[token]
+        return len(expired_refresh) + len(expired_access)
     
 def get_password_hash(password):
     return pwd_context.hash(password)
@@ -92,31 +157,77 @@ def save_user(username: str, password: str, user_id: str):
     # Save the username and hashed password as a Redis hash
     redis_client.hset(user_key, "user_id", user_id)
     redis_client.hset(user_key, "isThreat", isThreat)
+    # Reverse index so user_id lookups don't have to scan the keyspace
+    redis_client.set(f"user_id:{user_id}", username)
 
     print(f"User '{username}' saved.")
 
-def update_user_settings(user_id: str, settings: dict):
+def load_user_profile(user_id: str) -> Optional[dict]:
+    """Load settings, username and threat status with a single HGETALL."""
     username = username_from_user_id(user_id)
+    if not username:
+        return None
+    fields = {key.decode('utf-8'): value.decode('utf-8')
+              for key, value in redis_client.hgetall(f"user:{username}").items()}
+    return {
+        "username": username,
+        "personal_email": fields.get("personal_email"),
+        "friend_email": fields.get("friend_email"),
+        "safe_word": fields.get("safe_word"),
+        "isThreat": fields.get("isThreat") == "True",
+    }
+
+def get_user_profile(user_id: str) -> dict:
+    return user_cache.get(user_id, load_user_profile) or {}
+
+def update_user_settings(user_id: str, settings: dict):
+    username = get_user_profile(user_id).get("username")
     user_key = f"user:{username}"
+    pipe = redis_client.pipeline(transaction=False)
     for key, value in settings.items():
-        redis_client.hset(user_key, key, value)
+        pipe.hset(user_key, key, value)
+    pipe.execute()
+    user_cache.update(user_id, settings)
     print(f"Settings updated for user")
     return None
 
 def get_user_settings(user_id: str) -> dict:
-    username = username_from_user_id(user_id)
-    user_key = f"user:{username}"
-    personal_email = redis_client.hget(user_key, "personal_email")
-    friend_email = redis_client.hget(user_key, "friend_email")
-    safe_word = redis_client.hget(user_key, "safe_word")
+    profile = get_user_profile(user_id)
     settings = {
-        "personal_email": personal_email.decode('utf-8') if personal_email else None,
-        "friend_email": friend_email.decode('utf-8') if friend_email else None,
-        "safe_word": safe_word.decode('utf-8') if safe_word else None
+        "personal_email": profile.get("personal_email"),
+        "friend_email": profile.get("friend_email"),
+        "safe_word": profile.get("safe_word")
     }
-    print(f"Settings retrieved for user")
     return settings
 
+_non_word_pattern = re.compile(r"[\W_]+")
+
+def normalize_text(text: str) -> str:
+    """Lowercase and replace punctuation with single spaces."""
+    return _non_word_pattern.sub(" ", text.lower()).strip()
+
+@lru_cache(maxsize=USER_CACHE_SIZE)
+def compile_safe_word(safe_word: Optional[str]) -> Optional[re.Pattern]:
+    words = normalize_text(safe_word or "").split()
+    if not words:
+        return None
+    # The exact combination of words, in order, not only part of it
+    return re.compile(r"\b" + r" ".join(re.escape(word) for word in words) + r"\b")
+
+def safe_word_matcher(user_id: str) -> Optional[re.Pattern]:
+    # Follows the cached profile, so a new safe word is picked up as soon as it is saved
+    return compile_safe_word(get_user_settings(user_id).get("safe_word"))
+
+def contains_safe_word(message: str, user_id: str) -> bool:
+    """
+    Check the transcript for the user's safe word without calling Gemini.
+    Case and punctuation are ignored.
+    """
+    matcher = safe_word_matcher(user_id)
+    if not matcher or not message:
+        return False
+    return matcher.search(normalize_text(message)) is not None
+
 def create_gmaps_link(gps_dict: dict) -> str:
     lat = gps_dict.get("lat")
     long = gps_dict.get("long")
@@ -124,6 +235,17 @@ def create_gmaps_link(gps_dict: dict) -> str:
         return f"https://www.google.com/maps/search/?api=1&query={lat},{long}"
     return None
 
+def create_gmaps_path_link(path: list[Point]) -> Optional[str]:
+    """Directions link from the oldest to the latest point of a recent path, through the ones between."""
+    if len(path) < 2:
+        return None
+    (origin_lat, origin_long), (lat, long) = path[0], path[-1]
+    link = (f"https://www.google.com/maps/dir/?api=1&travelmode=walking"
+            f"&origin={origin_lat},{origin_long}&destination={lat},{long}")
+    if len(path) > 2:
+        link += "&waypoints=" + "%7C".join(f"{lat},{long}" for lat, long in path[1:-1])
+    return link
+
 def change_threat_status(user_id: str, status: bool):
     """
     Change the threat status for a user.
@@ -132,24 +254,26 @@ def change_threat_status(user_id: str, status: bool):
         username (str): The username
         status (bool): The new threat status
     """
-    username = username_from_user_id(user_id)
+    username = get_user_profile(user_id).get("username")
     user_key = f"user:{username}"
     # Convert bool to string 'True' or 'False' and encode to bytes
     status_bytes = str(status).encode('utf-8')
     redis_client.hset(user_key, "isThreat", status_bytes)
+    user_cache.update(user_id, {"isThreat": status})
 
     print(f"User status changed.")
 
 def check_threat_status(user_id: str) -> bool:
-    username = username_from_user_id(user_id)
-    user_key = f"user:{username}"
-    status = redis_client.hget(user_key, "isThreat")
-
-
-    if status == b'True':
-        return True
-    else:
+    """
+    Whether the user is under threat, read from Redis rather than the profile cache:
+    a /cancel handled by another worker must be seen before an alert goes out.
+    """
+    username = get_user_profile(user_id).get("username")
+    if not username:
         return False
+    status = redis_client.hget(f"user:{username}", "isThreat") == b"True"
+    user_cache.update(user_id, {"isThreat": status})
+    return status
 
 
 def check_user(username: str, password: str) -> bool:
@@ -168,16 +292,30 @@ def user_id_from_username(username: str) -> str:
     return user_id.decode('utf-8') if user_id else None
 
 def username_from_user_id(user_id: str) -> str:
+    username = redis_client.get(f"user_id:{user_id}")
+    return username.decode('utf-8') if username else None
+
+def backfill_user_id_index() -> int:
+    """
+    Build the user_id -> username index for users saved before it existed.
+    One-shot migration, safe to run more than once.
+
+    Returns:
+        int: The number of users indexed.
+    """
+    count = 0
+    pipe = redis_client.pipeline(transaction=False)
     for key in redis_client.scan_iter(match="user:*"):
-        # For each user key, check if the user_id matches
         stored_user_id = redis_client.hget(key, "user_id")
-        
-        if stored_user_id and stored_user_id.decode('utf-8') == user_id:
-            # Extract username from the key (remove "user:" prefix)
-            username = key.decode('utf-8').split(':')[1]
-            return username
-        
-    return None
+        if not stored_user_id:
+            continue
+        # Extract username from the key (remove "user:" prefix)
+        username = key.decode('utf-8').split(':', 1)[1]
+        pipe.set(f"user_id:{stored_user_id.decode('utf-8')}", username)
+        count += 1
+    pipe.execute()
+    print(f"Indexed {count} users.")
+    return count
 
 def reset_memorystore():
     redis_client.flushall()
@@ -195,35 +333,79 @@ def check_temp_and_upload_folders():
         print(upload_dir)
     return upload_dir
 
-async def save_file(file: UploadFile, file_name: str, upload_dir: str):
-    file_path = os.path.join(upload_dir, file_name)
-    print(f"Saving file to {file_path}")
-    file_bytes = await file.read()
-    with open(file_path, "wb") as f:
-        f.write(file_bytes)
+async def read_upload(file: UploadFile, upload_dir: str) -> Union[memoryview, str]:
+    """
+    Hand over the uploaded audio without extra copies or disk round trips.
+
+    Args:
+        file (UploadFile): The uploaded audio file
+        upload_dir (str): Where to spill uploads larger than UPLOAD_SPOOL_MAX_BYTES
+
+    Returns:
+        Union[memoryview, str]: A view on the in-memory upload buffer, or the path
+        of a uniquely named temp file when the upload is too large to keep in memory.
+        Pass the result to release_upload once it is no longer needed.
+    """
+    spooled = file.file
+    # Starlette spools small parts in a BytesIO, expose it directly instead of reading a copy
+    buffer = getattr(spooled, "_file", None)
+    if not getattr(spooled, "_rolled", True) and isinstance(buffer, io.BytesIO) \
+            and len(buffer.getbuffer()) <= UPLOAD_SPOOL_MAX_BYTES:
+        return buffer.getbuffer()
+
+    fd, file_path = tempfile.mkstemp(suffix=".wav", dir=upload_dir)
+    print(f"Spilling upload to {file_path}")
+    await file.seek(0)
+    with os.fdopen(fd, "wb") as f:
+        shutil.copyfileobj(spooled, f)
     return file_path
 
+def sweep_upload_dir(upload_dir: str, max_age: float = UPLOAD_FILE_MAX_AGE) -> int:
+    """
+    Delete spilled uploads that were never released, e.g. because the process crashed.
+
+    Returns:
+        int: The number of files deleted
+    """
+    cutoff = time.time() - max_age
+    count = 0
+    with os.scandir(upload_dir) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    count += 1
+            except FileNotFoundError:
+                # Released in the meantime
+                pass
+    return count
+
+def release_upload(audio: Union[memoryview, str]):
+    if isinstance(audio, str):
+        delete_file(audio)
+    elif isinstance(audio, memoryview):
+        audio.release()
+
 
 # Only for WAV
-def transcribe_audio(audio_path) -> speech.RecognizeResponse:
-    # Instantiates a client
-    client = speech.SpeechClient()
-    # Read audio file content
-    with open(audio_path, "rb") as audio_file:
-        content = audio_file.read()
-    audio = speech.RecognitionAudio(content=content)
-    config = speech.RecognitionConfig(
-        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-        sample_rate_hertz=16000, ###### Checkthe samplerate from the app TODO:
-        language_code="en-US",
-    )
-    # Detects speech in the audio file
-    response = client.recognize(config=config, audio=audio)
-    try:
-        return {'text': response.results[0].alternatives[0].transcript,
-                              'confidence': response.results[0].alternatives[0].confidence}
-    except Exception as e:
-        return {'text': "No speech detected", 'confidence': 0.0} 
+def transcribe_audio(audio: Union[bytes, memoryview, str], user_id: Optional[str] = None) -> dict:
+    if PREPROCESS_AUDIO:
+        try:
+            conditioned, stats = condition_audio(audio)
+        except Exception as e:
+            # Never drop a fragment because it could not be conditioned
+            print(f"Error conditioning audio: {e}")
+        else:
+            if conditioned is None:
+                print(f"No voice activity ({stats['voiced_frames']}/{stats['frames']} frames), skipping")
+                return {**NO_SPEECH, 'voiced': False}
+            audio = conditioned
+    if isinstance(audio, str):
+        # Spilled upload, read audio file content
+        with open(audio, "rb") as audio_file:
+            audio = audio_file.read()
+    # The recognizer reuses pooled clients and, in streaming mode, the user's open session
+    return get_recognizer().transcribe(audio, user_id)
 
 
 def delete_file(file_path: str):
@@ -236,30 +418,82 @@ def process_labels(labels:str) -> list[dict]:
     Process the labels from the model response.
 
     Args:
-        labels (str): The labels string from the model response.
+        labels (str): The labels string from the model response, JSON or the legacy format.
 
     Returns:
         dict: The processed labels as a dictionary.
     """    
-    # Regular expression to match category names and scores
-    pattern = r'<Category "(.*?)" \(displayName= score=(\d+\.\d+)'
-    # Find all matches
-    matches = re.findall(pattern, labels)
-    # Convert matches to a list of dictionaries
-    return [{"category": match[0], "score": float(match[1])} for match in matches]
-
-
-genai.configure(api_key=os.environ['GEMINI_API_KEY'])
-genai.GenerationConfig(
-  temperature=0
-)
-model = genai.GenerativeModel('gemini-1.5-flash')
-
+    return [{"category": category, "score": score} for category, score in parse_labels(labels)]
+
+
+model = services.lazy("gemini_model")
+
+SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_NONE",
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_NONE",
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_NONE",
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_NONE",
+    },
+]
+
+# Constrain the verdict to JSON, the alert text comes back in the same call
+THREAT_GENERATION_CONFIG = {
+    "temperature": 0,
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {
+            "threat_level": {"type": "string", "enum": ["0", "1"]},
+            "explanation": {"type": "string"},
+            "alert_message": {"type": "string"},
+        },
+        "required": ["threat_level", "explanation", "alert_message"],
+    },
+}
+
+THREAT_CACHE_SIZE = int(os.environ.get("THREAT_CACHE_SIZE", 4096))
+# cache key: verdict, for transcripts that were already judged
+_threat_cache: "OrderedDict[str, dict]" = OrderedDict()
+_threat_cache_lock = threading.Lock()
+
+def threat_cache_key(message: str, labels: Optional[str], safe_word: Optional[str]) -> str:
+    """Content address of a detect_threat call, the safe word only enters as a hash."""
+    safe_word_hash = hashlib.sha256((safe_word or "").encode('utf-8')).hexdigest()
+    content = "\x1f".join([normalize_text(message or ""), labels or "", safe_word_hash])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def parse_model_json(text: str) -> dict:
+    text = text.strip()
+    # Tolerate ```json fences in case the model adds them anyway
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.startswith("json"):
+            text = text[len("json"):]
+    return json.loads(text)
 
 # detect threat function
-def detect_threat(message:str, labels: str, user_id: str) -> dict:
+def detect_threat(message:str, labels: Optional[Labels], user_id: str) -> dict:
     user_settings = get_user_settings(user_id)
     safe_word = user_settings.get("safe_word")
+    # Only the strongest labels reach the prompt, the full classifier dump only costs tokens
+    labels = format_labels(top_labels(labels or ()))
+    cache_key = threat_cache_key(message, labels, safe_word)
+    with _threat_cache_lock:
+        cached = _threat_cache.get(cache_key)
+        if cached is not None:
+            _threat_cache.move_to_end(cache_key)
+            return dict(cached)
     messages=[
                     {
                         "role": "model",
@@ -269,15 +503,19 @@ def detect_threat(message:str, labels: str, user_id: str) -> dict:
                         Return a JSON response with:
                         - threat_level (0 for no threat or 1 for serious threat)
                         - explanation (short reason for the assessment. Do not use harmful content in the explanation). 
-                        Reply only with the threat level and explanation. 
+                        - alert_message (empty if threat_level is 0. If threat_level is 1, a threat alert in an informal way.
+                          The idea is that the recipient is alerted about a threat to the sender.
+                          Structure it as a short and concise alert email from first person.
+                          The main idea is to alert the recipient about a potential threat to the sender and to ask him/her to come and take him/her from there.
+                          DO NOT use requests to call back the sender, or to alert authorities.
+                          Only the email text body is needed, without any variables or placeholders.)
                         Use only the labels resulted from the analysis of the audio that the user sent and the recognized message from the audio.
                         Use the labels only to add more information to the one resulted from the message. 
                         If the safe_words are present in the message, the threat level should be 1.
                         It should be the exact combination of safe_words, not only part of it.
-                        Do not mention anything about the safe words in the message. Only explain that there is a threat.
+                        Do not mention anything about the safe words in the message, explanation or alert_message. Only explain that there is a threat.
                         Do not consider a threat if only the labels are threatening.
                         There will be no additional information. Send threat level 1 only if you are sure that it is an implicit or explicit threat.
-                        The response structure should be {"threat_level":"", "explanation":""} as a plain text.
                         """
                     },
                     {
@@ -286,32 +524,22 @@ def detect_threat(message:str, labels: str, user_id: str) -> dict:
                     }
                 ]
     
-    safe = [
-        {
-            "category": "HARM_CATEGORY_HARASSMENT",
-            "threshold": "BLOCK_NONE",
-        },
-        {
-            "category": "HARM_CATEGORY_HATE_SPEECH",
-            "threshold": "BLOCK_NONE",
-        },
-        {
-            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-            "threshold": "BLOCK_NONE",
-        },
-        {
-            "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-            "threshold": "BLOCK_NONE",
-        },
-    ]
     try:
-        response = model.generate_content(messages, safety_settings=safe)
-        dict_response = eval(response.text)
+        response = model.generate_content(messages, safety_settings=SAFETY_SETTINGS,
+                                          generation_config=THREAT_GENERATION_CONFIG)
+        dict_response = parse_model_json(response.text)
     except Exception as e:
         print(f'Error: {e}')
         return {"threat_level": 0, "explanation": "Error in threat detection"}
    
-    return {"threat_level": dict_response.get("threat_level"), "explanation": dict_response.get("explanation")}
+    result = {"threat_level": str(dict_response.get("threat_level")),
+              "explanation": dict_response.get("explanation"),
+              "alert_message": dict_response.get("alert_message") or None}
+    with _threat_cache_lock:
+        _threat_cache[cache_key] = result
+        if len(_threat_cache) > THREAT_CACHE_SIZE:
+            _threat_cache.popitem(last=False)
+    return dict(result)
 
 def generate_notif_message_from_explanation(explanation: str):
     message = [
@@ -334,52 +562,49 @@ def generate_notif_message_from_explanation(explanation: str):
         }
     ]
 
-    safe = [
-        {
-            "category": "HARM_CATEGORY_HARASSMENT",
-            "threshold": "BLOCK_NONE",
-        },
-        {
-            "category": "HARM_CATEGORY_HATE_SPEECH",
-            "threshold": "BLOCK_NONE",
-        },
-        {
-            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-            "threshold": "BLOCK_NONE",
-        },
-        {
-            "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-            "threshold": "BLOCK_NONE",
-        },
-    ]
-    response = model.generate_content(message, safety_settings=safe)
+    response = model.generate_content(message, safety_settings=SAFETY_SETTINGS)
     return response.text
 
-def add_location_to_notification(notification: str, gps: str) -> str:
-    gps_dict = {"lat": gps.split(';')[0].split(':')[1].strip(), 
-                        "long": gps.split(';')[1].split(':')[1].strip()}
-    gmaps_link = create_gmaps_link(gps_dict)
-    return f"{notification}\n\nLocation (click to open google maps location): \n{gmaps_link}" if gmaps_link else notification
-    
-def send_email_alert(user_id: str, alert_message: str) -> dict:
+def add_location_to_notification(notification: str, gps: Optional[str],
+                                 track: Optional[TrackSummary] = None) -> str:
     """
-    Creates formatted alert message and sending 
+    Append the user's location to the alert.
+
+    Args:
+        gps (Optional[str]): The gps sent with the fragment that raised the threat
+        track (Optional[TrackSummary]): The user's recent track, adds the path, speed and heading
+    """
+    point = track.latest if track is not None else parse_gps(gps)
+    if point is None:
+        return notification
+    gmaps_link = create_gmaps_link({"lat": point[0], "long": point[1]})
+    notification = f"{notification}\n\nLocation (click to open google maps location): \n{gmaps_link}"
+    if track is not None:
+        notification = f"{notification}\n{format_movement(track)}"
+        path_link = create_gmaps_path_link(track.path) if track.heading is not None else None
+        if path_link:
+            notification = f"{notification}\n\nRecent path: \n{path_link}"
+    return notification
+
+def format_location_update(track: TrackSummary) -> str:
+    """Follow-up sent to the contact after an alert, without calling Gemini."""
+    gmaps_link = create_gmaps_link({"lat": track.latest[0], "long": track.latest[1]})
+    received = datetime.fromtimestamp(track.time, timezone.utc).strftime("%H:%M:%S UTC")
+    return (f"Location update for your friend at {received}: \n{gmaps_link}\n"
+            f"{format_movement(track)}\n\n"
+            f"You will keep receiving updates until they cancel the alert.")
+
+def send_email_alert(user_id: str, alert_message: str, alert_id: Optional[str] = None,
+                     subject: str = ALERT_SUBJECT) -> bool:
+    """
+    Queue the alert for the user's trusted contact, it is delivered in the background
+    with retries. Queuing the same alert_id twice sends it only once.
     """
     user_settings = get_user_settings(user_id)
-
-    message = Mail(
-        to_emails=user_settings.get("friend_email"),
-        from_email=Email(os.environ.get("SENDGRID_SENDER")),
-        subject="ALERT: Potential Threat For your Friend Detected",
-        plain_text_content=alert_message
-        )
-    message.add_bcc(user_settings.get("personal_email"))
-    try:
-        response = sg.send(message)
-        print('Email sent')
-        return f"email.status_code={response.status_code}"
-        #expected 202 Accepted
-
-    except HTTPError as e:
-        print(str(e))
-        return str(e)
\ No newline at end of file
+    alert_id = alert_id or secrets.token_hex(16)
+    queued = alert_outbox.enqueue(alert_id, user_id,
+                                  to=user_settings.get("friend_email"),
+                                  bcc=user_settings.get("personal_email"),
+                                  body=alert_message, subject=subject)
+    print('Email queued' if queued else 'Email already queued')
+    return queued